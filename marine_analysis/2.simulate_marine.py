@@ -1,26 +1,34 @@
 import os
 import sys
-import deepdive as dd
 import numpy as np
 from datetime import datetime
 import pandas as pd
-import matplotlib.pyplot as plt
 import multiprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+import simulation_utilities as su
+import dataset_utilities as du
+# only the simulation modules of deepdive are imported (not the TensorFlow modelling stack)
+dd = su.load_deepdive_functions()
 
 #------ Simulation settings:
 n_CPUS = 3  # number of CPUs used for simulations
 n_training_simulations = 5  # simulations per CPU (the total should be ~10,000)
-n_test_simulations = 10  # simulations per CPU (the total should be e.g. 100 or 1000)
+n_test_simulations = 10  # total number of test simulations, run in parallel (e.g. 100 or 1000)
+shard_size = 10  # simulations per task sent to a CPU (small shards balance the load better)
+keep_shards = False  # keep the campaign log and seed index after saving the simulations
+resume_simulations = True  # only simulate the shards missing from a previous (interrupted) run with the same settings
+report_worker_startup = True  # print import time and memory usage of each simulation worker
+save_format = "npy"  # "npy" or "compressed" (chunked and compressed, with each feature stored in the smallest dtype)
+adaptive_budget = False  # simulate the training set in growing rounds until more simulations stop improving a probe model
+initial_training_simulations = 1000  # training simulations in the first round (adaptive_budget)
+budget_growth = 2  # the training set grows by this factor at each round, up to n_CPUS * n_training_simulations
+min_improvement = 0.02  # stop when the validation MSE of the probe model improves by less than this fraction
+probe_model = {'lstm_nodes': [64, 32], 'dense_nodes': [8], 'dropout': 0.05}  # model trained after each round
 training_seed = 1234
 test_seed = 4321
 outname = "marine"
 #------
 
-try:
-    os.mkdir('simulations/')
-except:
-    pass
-
 output_path = "simulations/"
 
 use_bins = True
@@ -39,6 +47,7 @@ root_age = np.max(time_bins)
 
 
 def plot_feat(features, indx):
+    import matplotlib.pyplot as plt  # only imported when plotting, not in simulation workers
     plt.step(-(time_bins + min_age_truncation), [features[0, indx]] + list(features[:, indx]))
     plt.gca().set_title("feature %s" % indx, fontweight="bold", fontsize=24)
     plt.show()
@@ -95,105 +104,125 @@ def create_sim_obj(rseed):
     return bd_sim, fossil_sim
 
 
-def run_sim(rep):
-    batch_features = []
-    batch_labels = []
-
-    # simulate training data
-    bd_sim, fossil_sim = create_sim_obj(training_seed + rep)
-    for i in range(n_training_simulations):
-        if i % 1 == 0 and rep == 0:
-            dd.print_update("%s of %s done" % (i+1, n_training_simulations))
-        sp_x = bd_sim.run_simulation(print_res=False)
-
-        # using min_age and max_age ensures that the time bins always span the same amount of time
-        sim = fossil_sim.run_simulation(sp_x, min_age=0, max_age=root_age, return_sqs_data=False)
-        sim_y = sim['global_true_trajectory']
-        sim_features = dd.extract_sim_features(sim)
-        batch_features.append(sim_features)
-        batch_labels.append(sim_y)
-
-    res = {'features': batch_features,
-           'labels': batch_labels}
-    return res
-
-
-def run_test_sim(rep):
-    batch_features = []
-    batch_labels = []
-
-    # simulate training data
-    sim_settings = []
-    bd_sim, fossil_sim = create_sim_obj(test_seed + rep)
-    for i in range(n_test_simulations):
-        if i % 1 == 0 and rep == 0:
-            dd.print_update("%s of %s done" % (i+1, n_test_simulations))
-        sp_x = bd_sim.run_simulation(print_res=False)
-        sim = fossil_sim.run_simulation(sp_x, min_age=0, max_age=root_age, return_sqs_data=False)
-        sim_features = dd.extract_sim_features(sim)
-        sim_y = sim['global_true_trajectory']
-        batch_features.append(sim_features)
-        batch_labels.append(sim_y)
-
-        keys = ['time_specific_rate', 'species_specific_rate', 'area_specific_rate',
-                'a_var', 'n_bins', 'area_size', 'n_areas', 'n_species', 'n_sampled_species', 'tot_br_length',
-                'n_occurrences', 'slope_pr', 'pr_at_origination', 'time_bins_duration', 'eta', 'p_gap',
-                'area_size_concentration_prm', 'link_area_size_carrying_capacity',
-                'slope_log_sampling', 'intercept_initial_sampling', 'sd_through_time', 'additional_info']
-
-        s = {key: sim[key] for key in keys}
-        sim_settings.append(s)
-
-    res = {'features': batch_features,
-            'labels': batch_labels,
-            'settings': sim_settings}
-    return res
+# simulation settings saved for each test simulation
+sim_settings_keys = ['time_specific_rate', 'species_specific_rate', 'area_specific_rate',
+                     'a_var', 'n_bins', 'area_size', 'n_areas', 'n_species', 'n_sampled_species', 'tot_br_length',
+                     'n_occurrences', 'slope_pr', 'pr_at_origination', 'time_bins_duration', 'eta', 'p_gap',
+                     'area_size_concentration_prm', 'link_area_size_carrying_capacity',
+                     'slope_log_sampling', 'intercept_initial_sampling', 'sd_through_time', 'additional_info']
 
 
-if __name__ == "__main__":
-    ### SIMULATE MULTIPLE DATASETS ###
-    # parallel simulations
-    if n_training_simulations:
+def simulate(rseed, save_settings=False):
+    # run a single simulation and return its features, labels and (optionally) settings
+    bd_sim, fossil_sim = create_sim_obj(rseed)
+    sp_x = bd_sim.run_simulation(print_res=False)
 
-        list_args = list(np.arange(n_CPUS))
-        print("\nSimulating training data...")
-        pool = multiprocessing.Pool()
-        res = pool.map(run_sim, list_args)
-        pool.close()
-
-        features = []
-        labels = []
+    # using min_age and max_age ensures that the time bins always span the same amount of time
+    sim = fossil_sim.run_simulation(sp_x, min_age=0, max_age=root_age, return_sqs_data=False)
+    sim_features = dd.extract_sim_features(sim)
+    sim_y = sim['global_true_trajectory']
 
-        for i in range(n_CPUS):
-            features = features + res[i]['features']
-            labels = labels + res[i]['labels']
+    s = None
+    if save_settings:
+        s = {key: sim[key] for key in sim_settings_keys}
+    return sim_features, sim_y, s
 
-        Xt = np.array(features)
-        Yt = np.array(labels)
-        print(Xt.shape, Yt.shape)
-        # save simulations
-        np.save(os.path.join(output_path, outname + "_sim_features" + ".npy"), Xt)
-        np.save(os.path.join(output_path, outname + "_sim_labels" + ".npy"), Yt)
 
-        print("Training features saved as: \n", os.path.join(output_path, outname + "_sim_features" + ".npy"))
-        print("Training labels saved as: \n", os.path.join(output_path, outname + "_sim_labels" + ".npy\n"))
+def run_sim(task):
+    # simulate one shard of the training or test set, writing directly into the output arrays
+    writer = su.CampaignWriter(os.path.join(output_path, outname + "_shards"), prefix=task['prefix'])
+    for i in range(task['first_sim'], task['first_sim'] + task['n_sims']):
+        # each simulation has its own seed so the results don't depend on the number of CPUs
+        rseed = su.sim_seed(task['seed'], i)
+        sim_features, sim_y, s = simulate(rseed, save_settings=task['prefix'] == "test")
+        writer.add(i, sim_features, sim_y, seed=rseed, settings=s)
 
-    ### TEST DATASETS ###
-    if n_test_simulations:
-        res = run_test_sim(0)
+    # only a completion notice is sent back to the main process
+    return writer.close(task)
 
-        features = res['features']
-        labels = res['labels']
 
-        Xt = np.array(features)
-        Yt = np.array(labels)
-        # save simulations
-        np.save(os.path.join(output_path, outname + "_test_features" + ".npy"), Xt)
-        np.save(os.path.join(output_path, outname + "_test_labels" + ".npy"), Yt)
+if __name__ == "__main__":
+    # the output directory is only created when running the simulations (not when the script is
+    # imported to simulate on the fly during training)
+    try:
+        os.mkdir(output_path)
+    except:
+        pass
+
+    shard_dir = os.path.join(output_path, outname + "_shards")
+    # fingerprint of the simulation settings, a campaign is only resumed if they did not change
+    sim_fingerprint = su.settings_fingerprint(*create_sim_obj(training_seed))
+    ### SIMULATE MULTIPLE DATASETS ###
+    # parallel simulations
+    if n_training_simulations:
+        print("\nSimulating training data...")
+        if adaptive_budget:
+            manifest_file = su.run_adaptive_campaign(run_sim, simulate, shard_dir, "training",
+                                                     seed=training_seed,
+                                                     max_sims=n_CPUS * n_training_simulations,
+                                                     shard_size=shard_size,
+                                                     n_cpus=n_CPUS,
+                                                     initial_sims=initial_training_simulations,
+                                                     growth=budget_growth,
+                                                     min_improvement=min_improvement,
+                                                     probe_settings=probe_model,
+                                                     learning_curve_file=os.path.join(output_path, outname + "_learning_curve.csv"),
+                                                     resume=resume_simulations,
+                                                     print_update=dd.print_update,
+                                                     settings=sim_fingerprint,
+                                                     report_startup=report_worker_startup)
+        else:
+            manifest_file = su.run_campaign(run_sim, simulate, shard_dir, "training",
+                                            seed=training_seed,
+                                            n_sims=n_CPUS * n_training_simulations,
+                                            shard_size=shard_size,
+                                            n_cpus=n_CPUS,
+                                            resume=resume_simulations,
+                                            print_update=dd.print_update,
+                                            settings=sim_fingerprint,
+                                            report_startup=report_worker_startup)
+        print("Training shards manifest saved as: \n", manifest_file)
+
+        # move the campaign arrays to the output files
+        feature_file = os.path.join(output_path, outname + "_sim_features" + ".npy")
+        label_file = os.path.join(output_path, outname + "_sim_labels" + ".npy")
+        shapes = su.finalize_campaign(manifest_file, feature_file=feature_file, label_file=label_file)
+        if save_format == "compressed":
+            feature_file = du.compress_npy(feature_file)
+            label_file = du.compress_npy(label_file)
+        print(shapes[0], shapes[1])
+        if not keep_shards:
+            su.remove_shards(manifest_file)
+
+        print("Training features saved as: \n", feature_file)
+        print("Training labels saved as: \n", label_file)
 
-        print("Test features saved as: \n", os.path.join(output_path, outname + "_test_features" + ".npy"))
-        print("Test labels saved as: \n", os.path.join(output_path, outname + "_test_labels" + ".npy"))
-        sim_settings = res['settings']
+    ### TEST DATASETS ###
+    if n_test_simulations:
+        print("\nSimulating test data...")
+        manifest_file = su.run_campaign(run_sim, simulate, shard_dir, "test",
+                                        seed=test_seed,
+                                        n_sims=n_test_simulations,
+                                        shard_size=shard_size,
+                                        n_cpus=n_CPUS,
+                                        resume=resume_simulations,
+                                        print_update=dd.print_update,
+                                        settings=sim_fingerprint,
+                                        report_startup=report_worker_startup)
+
+        feature_file = os.path.join(output_path, outname + "_test_features" + ".npy")
+        label_file = os.path.join(output_path, outname + "_test_labels" + ".npy")
+        shapes = su.finalize_campaign(manifest_file, feature_file=feature_file, label_file=label_file)
+        if save_format == "compressed":
+            feature_file = du.compress_npy(feature_file)
+            label_file = du.compress_npy(label_file)
+
+        print("Test features saved as: \n", feature_file)
+        print("Test labels saved as: \n", label_file)
+        # settings records are merged in simulation order
+        sim_settings = su.merge_settings(manifest_file)
         dd.save_pkl(sim_settings, os.path.join(output_path, outname + "_test_sim_settings" + ".pkl"))
-        
+        if not keep_shards:
+            su.remove_shards(manifest_file)
+
     print("\ndone.\n")
@@ -9,6 +9,10 @@ from keras import layers
 import pickle as pk
 import matplotlib.pyplot as plt
 import multiprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+import dataset_utilities as du
+import training_utilities as tu
+import prediction_utilities as pu
 
 #------ Script settings:
 feature_file = "elephants_features.npy"
@@ -16,6 +20,23 @@ label_file = "elephants_labels.npy"
 sim_wd = "./simulations_elephants"
 model_wd = "./model_elephants"
 parallelize_all_models = False
+n_cpus = multiprocessing.cpu_count()  # cores shared by the models when training in parallel
+model_search = "grid"  # "grid": train all models fully, "halving": successive halving (only the best models are trained fully)
+halving_min_epochs = 10  # epochs trained by all models in the first round of successive halving
+halving_eta = 3  # only the best 1/halving_eta models continue after each round (for eta times as many epochs)
+fused_training = False  # train all models together as towers of a single model (one pass over the data for all)
+init_model_wd = None  # directory with trained models (same settings) to fine-tune instead of training from scratch
+max_rescaler_change = 0.2  # max relative change in the rescaled features allowed when fine-tuning
+simulate_on_the_fly = False  # train on new simulations generated while training instead of the feature/label files
+simulation_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "2.simulate_elephants.py")  # provides simulate()
+n_simulation_workers = 4  # processes simulating while the models are trained (simulate_on_the_fly)
+on_the_fly_seed = 1234
+validation_simulations = 1000  # simulations used to fit the rescaler and, with replay_validation, to validate the models
+replay_validation = True  # evaluate the models on the same validation simulations at each epoch
+steps_per_epoch = 100  # batches of new simulations per epoch (simulate_on_the_fly)
+streaming_input = False  # read and rescale the simulations batch by batch (for datasets larger than memory)
+share_training_set = False  # load and rescale the training set once for all models and share it across processes
+shared_wd = os.path.join(sim_wd, "shared_training_set")  # temporary rescaled copy of the training set (share_training_set)
 #------
 
 try:
@@ -61,49 +82,209 @@ def get_model_settings():
     return list_settings
 
 
-def run_model_training(d):
-    Xt = np.load(os.path.join(sim_wd, d['feature_file']))
-    Yt = np.load(os.path.join(sim_wd, d['label_file']))
-    infile_name = feature_file.split('.npy')[0]
+def label_transform(Yt):
+    return dd.normalize_labels(Yt, rescaler=1, log=True)
+
+
+def fit_feature_rescaler(Xt):
+    if not streaming_input:
+        feature_rescaler = dd.FeatureRescaler(np.asarray(Xt))
+    else:
+        # memory-mapped arrays and compressed datasets are read by chunks (same rescaling as dd.FeatureRescaler)
+        feature_rescaler = tu.fit_streaming_rescaler(Xt, dd.FeatureRescaler)
+    if init_model_wd is None:
+        return feature_rescaler
+    # when fine-tuning, the features are rescaled as in the training of the initial models
+    for d in get_model_settings():
+        filename = tu.find_trained_model(init_model_wd, d['model_name'])
+        if filename is not None:
+            init_rescaler = dd.load_rnn_model(init_model_wd, filename=filename)[2]
+            change = tu.rescaler_change(init_rescaler, feature_rescaler, np.asarray(Xt[:1000]))
+            if change > max_rescaler_change:
+                raise ValueError("The rescaled features differ from those used to train the models in %s "
+                                 "(relative change: %s), the models should be trained from scratch" % (
+                                  init_model_wd, np.round(change, 3)))
+            return init_rescaler
+    return feature_rescaler
+
+
+def load_training_set(d):
+    # training features and labels with the fitted feature rescaler
+    # ('streaming': trained batch by batch, 'rescaled': the arrays are already rescaled)
+    if 'shared_features' in d:
+        # training set rescaled once for the whole grid and memory-mapped (read-only) by each model
+        Xt_r, Yt_r = tu.load_shared_training_set(d)
+        return {'features': Xt_r, 'labels': Yt_r, 'feature_rescaler': d['feature_rescaler'],
+                'streaming': True, 'rescaled': True}
+    # .npy files or compressed datasets (.ddz), with streaming_input they are memory-mapped or read by chunks
+    Xt = du.load_array(os.path.join(sim_wd, d['feature_file']), lazy=streaming_input)
+    Yt = du.load_array(os.path.join(sim_wd, d['label_file']), lazy=streaming_input)
+    feature_rescaler = fit_feature_rescaler(Xt)
+    if streaming_input:
+        return {'features': Xt, 'labels': Yt, 'feature_rescaler': feature_rescaler,
+                'streaming': True, 'rescaled': False}
+    Xt_r = pu.rescale_features(feature_rescaler, Xt)
+    Yt_r = label_transform(Yt)
+    return {'features': Xt_r, 'labels': Yt_r, 'feature_rescaler': feature_rescaler,
+            'streaming': False, 'rescaled': True}
+
+
+def build_model(d, data):
+    if init_model_wd is not None:
+        filename = tu.find_trained_model(init_model_wd, d['model_name'])
+        if filename is not None:
+            print("Fine-tuning model:", filename)
+            model = dd.load_rnn_model(init_model_wd, filename=filename)[1]
+            if not tu.input_shape_matches(model, data['features']):
+                raise ValueError("Input shape of model %s %s does not match the features %s" % (
+                    filename, model.input_shape[1:], data['features'].shape[1:]))
+            return model
+        print("No trained model found for %s, training from scratch" % d['model_name'])
+    # only a few simulations are needed to set the input shape of the model
+    Xt_r = np.asarray(data['features'][:10])
+    if not data['rescaled']:
+        Xt_r = pu.rescale_features(data['feature_rescaler'], Xt_r)
+    return dd.build_rnn(Xt_r,
+                        lstm_nodes=d['lstm_nodes'],
+                        dense_nodes=d['dense_nodes'],
+                        loss_f=d['loss_f'],
+                        dropout_rate=d['dropout'])
+
+
+def fit_model(model, data, verbose=0, max_epochs=1000):
+    if data['streaming']:
+        # batches are read from the files (shared by all processes) rather than loaded in memory
+        if data['rescaled']:
+            return tu.fit_rnn_streaming(data['features'], data['labels'], model, None, None,
+                                        verbose=verbose, max_epochs=max_epochs, patience=5, batch_size=100)
+        return tu.fit_rnn_streaming(data['features'], data['labels'], model, data['feature_rescaler'],
+                                    label_transform, verbose=verbose, max_epochs=max_epochs, patience=5,
+                                    batch_size=100)
+    return dd.fit_rnn(data['features'], data['labels'], model, verbose=verbose, max_epochs=max_epochs,
+                      patience=5, batch_size=100)
+
+
+def save_model(d, model, history, feature_rescaler, wd=model_wd):
+    infile_name = feature_file.split('.npy')[0].split(du.COMPRESSED_EXT)[0]
     outname = infile_name + d['model_name']
+    print("\nSaving DeepDive model...\n")
+    os.makedirs(wd, exist_ok=True)
+    # rescalers fitted by chunks are saved as plain arrays
+    dd.save_rnn_model(wd, history, model, tu.portable_rescaler(feature_rescaler), filename=outname)
+    dd.plot_training_history(history, criterion='val_loss', wd=wd, show=False, filename=outname)
+    print("done.")
 
-    feature_rescaler = dd.FeatureRescaler(Xt)
-    Xt_r = feature_rescaler.feature_rescale(Xt)
-    Yt_r = dd.normalize_labels(Yt, rescaler=1, log=True)
-    #Yt_r = dd.normalize_labels(Yt, rescaler=0, log=False)
-    model = dd.build_rnn(Xt_r,
-                         lstm_nodes=d['lstm_nodes'],
-                         dense_nodes=d['dense_nodes'],
-                         loss_f=d['loss_f'],
-                         dropout_rate=d['dropout'])
+
+def run_model_training(d):
+    data = load_training_set(d)
+    model = build_model(d, data)
     verbose = 0
     if d['model_n'] == 0:
         verbose = 1
-    history = dd.fit_rnn(Xt_r, Yt_r, model, verbose=verbose, max_epochs=1000, patience=5,batch_size=100)
-    print("\nSaving DeepDive model...\n")
-    dd.save_rnn_model(model_wd, history, model, feature_rescaler, filename=outname)
-    dd.plot_training_history(history, criterion='val_loss', wd=model_wd, show=False, filename=outname)
-    print("done.")
+    history = fit_model(model, data, verbose=verbose)
+    save_model(d, model, history, data['feature_rescaler'])
+
+
+def run_successive_halving(list_settings):
+    # all models are built and trained in this process, but only the most promising ones are
+    # trained beyond the first rounds; the models dropped along the way are saved as they are (in model_wd/pruned)
+    data = load_training_set(list_settings[0])
+    models = {d['model_name']: build_model(d, data) for d in list_settings}
+    histories, converged = tu.successive_halving(models,
+                                                 lambda model, epochs: fit_model(model, data, max_epochs=epochs),
+                                                 max_epochs=1000, min_epochs=halving_min_epochs, eta=halving_eta)
+    for d in list_settings:
+        # models pruned before convergence are saved in a subfolder, so they are not used for predictions
+        wd = model_wd
+        if d['model_name'] not in converged:
+            wd = os.path.join(model_wd, "pruned")
+        save_model(d, models[d['model_name']], histories[d['model_name']], data['feature_rescaler'], wd=wd)
+
+
+def run_fused_training(list_settings):
+    # all models are trained in the same pass over the data, each with its own loss and early stopping
+    data = load_training_set(list_settings[0])
+    towers = {d['model_name']: build_model(d, data) for d in list_settings}
+    if data['rescaled']:
+        histories = tu.fit_fused_rnn(data['features'], data['labels'], towers, None, None,
+                                     verbose=1, max_epochs=1000, patience=5, batch_size=100)
+    else:
+        histories = tu.fit_fused_rnn(data['features'], data['labels'], towers, data['feature_rescaler'],
+                                     label_transform, verbose=1, max_epochs=1000, patience=5, batch_size=100)
+    for d in list_settings:
+        save_model(d, towers[d['model_name']], histories[d['model_name']], data['feature_rescaler'])
+
+
+def run_on_the_fly_training(list_settings):
+    # the models are trained one after the other, each on new simulations generated while training
+    stream = tu.SimulationStream(simulation_script, n_simulation_workers, seed=on_the_fly_seed)
+    Xv, Yv = stream.take(validation_simulations)
+    feature_rescaler = fit_feature_rescaler(Xv)
+    data = {'features': pu.rescale_features(feature_rescaler, Xv), 'labels': label_transform(Yv),
+            'feature_rescaler': feature_rescaler, 'streaming': False, 'rescaled': True}
+    validation_data = None
+    if replay_validation:
+        validation_data = (data['features'], data['labels'])
+    for d in list_settings:
+        model = build_model(d, data)
+        history = tu.fit_rnn_online(stream, model, feature_rescaler, label_transform,
+                                    validation_data=validation_data, verbose=1, max_epochs=1000, patience=5,
+                                    batch_size=100, steps_per_epoch=steps_per_epoch)
+        save_model(d, model, history, feature_rescaler)
+    print("Simulations used: %s" % stream.n_simulations)
+    stream.close()
 
 
 if __name__ == "__main__":
     nametag= 'base file name' 
 
     list_settings = get_model_settings()
-    
-    if parallelize_all_models:
-        for j in list_settings:
-            j['feature_file'] = feature_file
-            j['label_file'] = label_file
-
-        # run all jobs in parallel
-        pool = multiprocessing.Pool(len(list_settings))
-        pool.map(run_model_training, list_settings)
-        pool.close()
-    else:
-        for j in list_settings:
-            j['feature_file'] = feature_file
-            j['label_file'] = label_file
-            run_model_training(j)
-        
 
+    shared = None
+    try:
+        if share_training_set and not simulate_on_the_fly:
+            print("Loading and rescaling the training set...")
+            shared = tu.prepare_shared_training_set(os.path.join(sim_wd, feature_file),
+                                                    os.path.join(sim_wd, label_file),
+                                                    fit_feature_rescaler, label_transform, shared_wd)
+            for j in list_settings:
+                j.update(shared)
+
+        if simulate_on_the_fly:
+            run_on_the_fly_training(list_settings)
+        elif model_search == "halving":
+            for j in list_settings:
+                j['feature_file'] = feature_file
+                j['label_file'] = label_file
+            run_successive_halving(list_settings)
+        elif fused_training:
+            for j in list_settings:
+                j['feature_file'] = feature_file
+                j['label_file'] = label_file
+            run_fused_training(list_settings)
+        elif parallelize_all_models:
+            for j in list_settings:
+                j['feature_file'] = feature_file
+                j['label_file'] = label_file
+
+            # run all jobs in parallel: each model gets a number of threads based on its estimated cost
+            # and the models are started (costliest first) as soon as enough cores are available
+            input_shape = du.load_array(os.path.join(sim_wd, feature_file), lazy=True).shape
+            costs = [tu.estimate_model_cost(j['lstm_nodes'], j['dense_nodes'], input_shape[2], input_shape[1])
+                     for j in list_settings]
+            report = tu.run_scheduled(run_model_training, list_settings, costs, n_cpus,
+                                      names=[j['model_name'] for j in list_settings])
+            print(report)
+            report.to_csv(os.path.join(model_wd, "training_schedule.csv"), index=False)
+            failed = report['model'][report['error'].notna()]
+            if len(failed):
+                sys.exit("Training failed for: %s (see training_schedule.csv)" % ", ".join(failed))
+        else:
+            for j in list_settings:
+                j['feature_file'] = feature_file
+                j['label_file'] = label_file
+                run_model_training(j)
+    finally:
+        # the rescaled copy of the training set is removed even if the training fails
+        if shared is not None:
+            tu.remove_shared_training_set(shared)
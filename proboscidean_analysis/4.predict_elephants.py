@@ -1,7 +1,6 @@
 import os
 import sys
 import glob
-import deepdive as dd
 import numpy as np
 from datetime import datetime
 import pandas as pd
@@ -9,6 +8,12 @@ import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.backends import backend_pdf  # saves pdfs
 import multiprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+import dataset_utilities as du
+import prediction_utilities as pu
+import simulation_utilities as su
+import parallel_utilities as pl
+import prediction_server as ps
 import scipy.ndimage as nd
 import copy
 today = datetime.now()
@@ -24,17 +29,38 @@ data_wd = './elephant_deepdive_data'
 testset_wd = "./simulations_elephants"
 model_wd = "./model_elephants"
 output_wd = "./output"
+input_cache_dir = os.path.join(output_wd, "input_cache")  # parsed empirical inputs reused across models and runs (None: no cache on disk)
+numpy_inference = False  # run the models with the NumPy kernel (exported once to model_wd/numpy_kernels) instead of TensorFlow
+n_workers = 1  # models evaluated in parallel
+n_threads = max(1, multiprocessing.cpu_count() // n_workers)  # threads used by each worker
+serve_predictions = False  # keep the models loaded and serve predictions on localhost (see utilities/prediction_server.py)
+server_port = 8765
 
 feature_file = "elephants_test_features.npy"
 label_file = "elephants_test_labels.npy"
+test_settings_file = None  # settings of the test simulations, e.g. "test_sim_settings<date>.pkl" (None: metrics not stratified)
+stratify_by = ['n_species', 'p_gap']  # test metrics are also computed within quantile bins of these settings
+n_strata = 4  # quantile bins per setting
+interval_level = 0.95  # MC dropout prediction interval used to compute the coverage
+coverage_predictions = 100  # MC dropout draws per test simulation used to estimate the interval
+test_batch_size = 1000  # test simulations evaluated per batch
 res_file = "elephants_results"
 #------
 
+if numpy_inference:
+    # only the deepdive functions used to read the data are imported, so that the prediction workers
+    # do not load TensorFlow (the full package is only imported to export the models and to plot)
+    dd = su.load_deepdive_functions(['prep_dd_input', 'normalize_labels'])
+else:
+    import deepdive as dd
+
 
 try:
     os.mkdir(output_wd)
 except:
     pass
+# the empirical input of each replicate is parsed only once and shared by all models
+input_cache = pu.InputCache(dd.prep_dd_input, cache_dir=input_cache_dir)
 level = "Species_occurrences"
 # scaling_options: None, "1-mean", "first-bin"
 scaling = None
@@ -57,37 +83,101 @@ n_time_bins = len(time_bins) - 1
 fig = plt.figure(figsize=(12, 8))
 predictions = []
 
-def plot_all_models():
+def load_replicate(data_wd, replicate):
+    # empirical features of a replicate (parsed once, see input_cache)
+    features, info = input_cache.prep_dd_input(data_wd,
+                                               bin_duration_file='t_bins.csv',  # from old to recent, array of shape (t)
+                                               locality_file='%s_localities.csv' % replicate,  # array of shape (a, t)
+                                               locality_dir='Locality',
+                                               taxon_dir=level,
+                                               hr_time_bins=time_bins,  # array of shape (t)
+                                               rescale_by_n_bins=True,
+                                               no_age_u=True,
+                                               replicate=replicate,
+                                               debug=False)
+    return features
+
+
+def load_empirical_features():
+    return [load_replicate(data_wd, replicate) for replicate in range(1, replicates + 1)]
+
+
+def load_model(model_i, filename):
+    # returns training history, model and feature rescaler
+    if not numpy_inference:
+        return dd.load_rnn_model(model_wd, filename=filename)
+    # the model is exported (once, or again after retraining) and then run without TensorFlow
+    kernel_file = os.path.join(model_wd, "numpy_kernels", filename + ".npz")
+    if not os.path.exists(kernel_file) or os.path.getmtime(kernel_file) < os.path.getmtime(model_i):
+        os.makedirs(os.path.dirname(kernel_file), exist_ok=True)
+        import deepdive as dd_full  # the numpy mode only imports the full package to export the models
+        history, model, feature_rescaler = dd_full.load_rnn_model(model_wd, filename=filename)
+        pu.export_rnn(model, feature_rescaler, kernel_file, history=history)
+    return pu.load_numpy_rnn(kernel_file)
+
+
+def evaluate_model(job):
+    # load a model once to run the empirical predictions and the test set evaluation
+    model_i, features_list, strata = job
+    filename = model_i.split(sep="rnn_model")[1]
+    print("\nModel", filename)
+    # load model trained using age uncertainty
+    history, model, feature_rescaler = load_model(model_i, filename)
+
+    # all replicates and draws in a few large forward passes, from recent to old
+    pred_div = pu.predict_ensemble(features_list, model, feature_rescaler,
+                                   n_predictions=n_predictions, dropout=True)
+
+    #  Run model on test set to estimate accuracy
+    # .npy files are memory-mapped and compressed datasets (.ddz) read by chunks
+    f = du.load_array(os.path.join(testset_wd, feature_file), lazy=True)
+    l = du.load_array(os.path.join(testset_wd, label_file), lazy=True)
+    val_loss = np.min(history["val_loss"])  # check validation loss
+    t_loss = history["loss"][np.argmin(history["val_loss"])]  # training loss
+    epochs = np.argmin(history["val_loss"])  # number of epochs used to train
+    # run predictions (in batches), with per time bin MSE, bias and interval coverage
+    print("Running model:", filename)
+    metrics = pu.evaluate_test_set(model, feature_rescaler, f, l,
+                                   label_transform=lambda y: dd.normalize_labels(y, rescaler=1, log=True),
+                                   strata=strata,
+                                   n_predictions=coverage_predictions,
+                                   interval=interval_level,
+                                   batch_size=test_batch_size)
+    overall = metrics[metrics["setting"] == "all"]
+    mse = np.mean(overall["MSE"])
+    bias = np.mean(overall["bias"])
+    coverage = np.mean(overall["coverage"])
+    metrics.insert(0, "Model", filename)
+    return {'pred_div': pred_div, 'metrics': metrics,
+            'res': [filename, epochs, t_loss, val_loss, mse, bias, coverage]}
+
+
+def run_server():
+    # all models are loaded once and the server runs until interrupted (Ctrl+C)
+    # requests can include the features or the replicates to read, e.g. {"data_wd": path, "replicate": 1}
+    models = {}
+    for model_i in model_list:
+        filename = model_i.split(sep="rnn_model")[1]
+        print("Loading model:", filename)
+        history, model, feature_rescaler = load_model(model_i, filename)
+        models[filename] = (model, feature_rescaler)
+    ps.serve(models, load_input=lambda item: load_replicate(item.get('data_wd', data_wd), item['replicate']),
+             port=server_port)
+
+
+### PLOT BY MODEL
+def plot_all_models(features_list, results):
     fig = plt.figure(figsize=(12, 8))
     prediction_color = "b"
     alpha = 0.2
     predictions = []
-    for model_i in model_list:
-        filename = model_i.split(sep="rnn_model")[1]
-        print("\nModel", filename)
-        # load model trained using age uncertainty
-        history, model, feature_rescaler = dd.load_rnn_model(model_wd, filename=filename)
 
+    # from recent to old
+    plot_time_axis = np.sort(time_bins)
+
+    for model_res in results:
         for replicate in range(1, replicates + 1):
-            features, info = dd.prep_dd_input(data_wd,
-                                              bin_duration_file='t_bins.csv',  # from old to recent, array of shape (t)
-                                              locality_file='%s_localities.csv' % replicate,  # array of shape (a, t)
-                                              locality_dir='Locality',
-                                              taxon_dir=level,
-                                              hr_time_bins=time_bins,  # array of shape (t)
-                                              rescale_by_n_bins=True,
-                                              no_age_u=True,
-                                              replicate=replicate,
-                                              debug=False)
-
-            # from recent to old
-            plot_time_axis = np.sort(time_bins)
-
-            dd.print_update("Running replicate n. %s" % replicate)
-
-            # from recent to old
-            pred_div = dd.predict(features, model, feature_rescaler,
-                                  n_predictions=n_predictions, dropout=True)
+            pred_div = model_res['pred_div'][replicate - 1]
 
             pred = np.mean(np.exp(pred_div) - 1, axis=0)
             if scaling == "1-mean":
@@ -107,60 +197,66 @@ def plot_all_models():
 
             predictions.append(pred)
 
-        predictions = np.array(predictions)
-
-        dd.add_geochrono(0, -4.8, max_ma=-66, min_ma=0)
-        plt.ylim(bottom=-4.8, top=80)
-        plt.xlim(-66, 0)
-        plt.ylabel("Species diversity", fontsize=15)
-        plt.xlabel("Time (Ma)", fontsize=15)
-        fig.show()
-        file_name = os.path.join(output_wd, res_file + ".pdf")
-        ele_plot = matplotlib.backends.backend_pdf.PdfPages(file_name)
-        ele_plot.savefig(fig)
-        ele_plot.close()
-        print("Plot saved as:", file_name)
-        return features
+    predictions = np.array(predictions)
+    # diversity predicted by each model for each replicate and draw (not rescaled)
+    ensemble = np.exp(np.array([model_res['pred_div'] for model_res in results])) - 1
+    np.save(os.path.join(output_wd, res_file + "_predictions.npy"), ensemble)
 
+    dd.add_geochrono(0, -4.8, max_ma=-66, min_ma=0)
+    plt.ylim(bottom=-4.8, top=80)
+    plt.xlim(-66, 0)
+    plt.ylabel("Species diversity", fontsize=15)
+    plt.xlabel("Time (Ma)", fontsize=15)
+    fig.show()
+    file_name = os.path.join(output_wd, res_file + ".pdf")
+    ele_plot = matplotlib.backends.backend_pdf.PdfPages(file_name)
+    ele_plot.savefig(fig)
+    ele_plot.close()
+    print("Plot saved as:", file_name)
+    return features_list[-1]
 
 
 if __name__=="__main__":
-    # Run predictions and create plots
-    features = plot_all_models()
-    
+    if serve_predictions:
+        run_server()
+        sys.exit()
+
+    features_list = load_empirical_features()
+    strata = None
+    if test_settings_file is not None:
+        if os.path.exists(os.path.join(testset_wd, test_settings_file)):
+            strata = pu.load_settings_strata(os.path.join(testset_wd, test_settings_file), stratify_by, n_strata)
+        else:
+            print("Test settings file not found (%s): test metrics are not stratified" % test_settings_file)
+
+    # each model is loaded once for the empirical predictions and the test set (MSE)
+    print("\n\nRunning predictions and calculating MSE on test set...")
+    jobs = [(model_i, features_list, strata) for model_i in model_list]
+    if n_workers > 1:
+        results = pl.map_with_thread_budget(evaluate_model, jobs, n_workers, n_threads)
+    else:
+        results = [evaluate_model(job) for job in jobs]
+
+    # create plots
+    if numpy_inference:
+        import deepdive as dd
+    features = plot_all_models(features_list, results)
+
     # Get stats for model training in a pandas dataframe
-    print("\n\nCalculating MSA on test set...")
-    #  Run model on test set to estimate accuracy
-    ffile = os.path.join(testset_wd, feature_file)
-    lfile = os.path.join(testset_wd, label_file)
-    f = np.load(ffile)
-    l = np.load(lfile)
-
-    res = list()
-    for i in model_list:
-        filename = i.split(sep="rnn_model")[1]
-        history, model, feature_rescaler = dd.load_rnn_model(model_wd, filename=filename)
-        val_loss = np.min(history["val_loss"])  # check validation loss
-        t_loss = history["loss"][np.argmin(history["val_loss"])]  # training loss
-        epochs = np.argmin(history["val_loss"])  # number of epochs used to train
-        try:
-            Xt_r = feature_rescaler.feature_rescale(f)
-        except:
-            Xt_r = f * feature_rescaler
-        Yt_r = dd.normalize_labels(l, rescaler=1, log=True)
-        # run predictions
-        y = np.array(model(Xt_r))
-        print("Running model:", filename)
-        mse = np.mean((y[:, :, 0] - Yt_r)**2)
-
-        res.append([filename, epochs, t_loss, val_loss,mse])
+    res = [model_res['res'] for model_res in results]
     res = pd.DataFrame(res)
-    res.columns = ["Model", "training_epochs", "training_MSE", "validation_MSE", "test_MSE"]
+    res.columns = ["Model", "training_epochs", "training_MSE", "validation_MSE", "test_MSE", "test_bias",
+                   "test_coverage"]
     res.to_csv( os.path.join(output_wd, res_file + ".csv" ),
                 index=False)
     print("Output saved in:", os.path.join(output_wd, res_file + ".csv"))
+    # test metrics by time bin and stratum of the simulation settings
+    metrics = pd.concat([model_res['metrics'] for model_res in results])
+    metrics.to_csv(os.path.join(output_wd, res_file + "_test_metrics.csv"), index=False)
+    print("Test set metrics saved in:", os.path.join(output_wd, res_file + "_test_metrics.csv"))
     
     print("Plotting features")
+    f = du.load_array(os.path.join(testset_wd, feature_file))
     dd.plot_feature_hists(test_features=f, empirical_features=features,
         show=False, wd=output_wd, output_name=res_file + "_features")
 
@@ -0,0 +1,167 @@
+# Functions for saving and reading simulated datasets in a compact, chunked and compressed format
+# Used by the 2.simulate_*.py, 3.deepdive_model_training.py and 4.predict_*.py scripts
+#
+# A compressed dataset is a directory (by default with extension .ddz) containing:
+#   index.json      shape and dtype of the full array and the list of chunks
+#   chunk_<k>.npz   rows [k * chunk_rows, (k + 1) * chunk_rows) compressed with zlib, one array per
+#                   column (last axis), each stored with the smallest dtype that represents it
+import os
+import json
+import shutil
+import numpy as np
+
+COMPRESSED_EXT = ".ddz"
+INT_DTYPES = [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32, np.int64]
+
+
+def select_dtype(values, max_rel_error=1e-6):
+    # smallest dtype representing the values: integers are stored losslessly, other values
+    # as float16 or float32 if the relative rounding error is within max_rel_error
+    values = np.asarray(values)
+    if values.dtype.kind in "iub" or (np.all(np.isfinite(values)) and np.all(values == np.round(values))):
+        if values.size == 0:
+            return np.dtype(np.uint8)
+        lo, hi = np.min(values), np.max(values)
+        for dtype in INT_DTYPES:
+            info = np.iinfo(dtype)
+            if lo >= info.min and hi <= info.max:
+                return np.dtype(dtype)
+    if values.dtype.kind == "f":
+        for dtype in [np.float16, np.float32]:
+            if np.dtype(dtype).itemsize >= values.dtype.itemsize:
+                break
+            with np.errstate(over='ignore', invalid='ignore'):
+                rounded = values.astype(dtype).astype(values.dtype)
+                err = np.abs(rounded - values)
+            finite = np.isfinite(values)
+            if np.array_equal(np.isfinite(rounded), finite) and \
+                    np.all(err[finite] <= max_rel_error * np.abs(values[finite])):
+                return np.dtype(dtype)
+    return values.dtype
+
+
+class DatasetWriter():
+    # Writes an array to a compressed dataset one block of rows at a time
+    def __init__(self, path, row_shape, dtype, chunk_rows=1000, max_rel_error=1e-6):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        self.path = path
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+        self.max_rel_error = max_rel_error
+        self.chunks = []
+        self.n_rows = 0
+        self._buffer = []
+
+    def write(self, rows):
+        rows = np.asarray(rows)
+        i = 0
+        while i < len(rows):
+            n_buffered = int(np.sum([len(b) for b in self._buffer]))
+            n = min(self.chunk_rows - n_buffered, len(rows) - i)
+            self._buffer.append(rows[i:i + n])
+            i += n
+            if n_buffered + n == self.chunk_rows:
+                self._write_chunk()
+
+    def _write_chunk(self):
+        if len(self._buffer) == 0:
+            return
+        block = np.concatenate(self._buffer)
+        self._buffer = []
+        columns = block.reshape(len(block), -1, self.row_shape[-1] if len(self.row_shape) else 1)
+        arrays, dtypes = {}, []
+        for j in range(columns.shape[-1]):
+            col = columns[..., j]
+            dtype = select_dtype(col, self.max_rel_error)
+            arrays["col_%s" % j] = col.astype(dtype)
+            dtypes.append(dtype.str)
+        file_name = "chunk_%s.npz" % len(self.chunks)
+        np.savez_compressed(os.path.join(self.path, file_name), **arrays)
+        self.chunks.append({'file': file_name, 'start': self.n_rows, 'n_rows': len(block), 'dtypes': dtypes})
+        self.n_rows += len(block)
+
+    def close(self):
+        self._write_chunk()
+        index = {'shape': [self.n_rows] + list(self.row_shape),
+                 'dtype': self.dtype.str,
+                 'chunk_rows': self.chunk_rows,
+                 'chunks': self.chunks}
+        with open(os.path.join(self.path, "index.json"), "w") as f:
+            json.dump(index, f, indent=1)
+        return self.path
+
+
+class CompressedDataset():
+    # Random access to the rows of a compressed dataset, only decompressing the chunks it touches
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            self.index = json.load(f)
+        self.shape = tuple(self.index['shape'])
+        self.dtype = np.dtype(self.index['dtype'])
+        self.chunk_rows = self.index['chunk_rows']
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read_chunk(self, k, dtype=None):
+        chunk = self.index['chunks'][k]
+        out = np.empty((chunk['n_rows'],) + self.shape[1:], dtype=dtype or self.dtype)
+        columns = out.reshape(chunk['n_rows'], -1, self.shape[-1] if len(self.shape) > 1 else 1)
+        with np.load(os.path.join(self.path, chunk['file'])) as data:
+            for j in range(columns.shape[-1]):
+                columns[..., j] = data["col_%s" % j]
+        return out
+
+    def read(self, start=0, stop=None, dtype=None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        out = np.empty((max(stop - start, 0),) + self.shape[1:], dtype=dtype or self.dtype)
+        for k in range(start // self.chunk_rows, int(np.ceil(stop / self.chunk_rows))):
+            chunk = self.index['chunks'][k]
+            block = self.read_chunk(k, dtype)
+            lo = max(start, chunk['start'])
+            hi = min(stop, chunk['start'] + chunk['n_rows'])
+            out[lo - start:hi - start] = block[lo - chunk['start']:hi - chunk['start']]
+        return out
+
+    def __getitem__(self, item):
+        if isinstance(item, slice) and item.step in [None, 1]:
+            start, stop, _ = item.indices(len(self))
+            return self.read(start, stop)
+        return self.read()[item]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.read(dtype=dtype)
+
+
+def save_dataset(path, arr, chunk_rows=1000, max_rel_error=1e-6):
+    # arr can be a memory-mapped array: it is read one chunk at a time
+    writer = DatasetWriter(path, arr.shape[1:], arr.dtype, chunk_rows=chunk_rows, max_rel_error=max_rel_error)
+    for i in range(0, len(arr), chunk_rows):
+        writer.write(arr[i:i + chunk_rows])
+    return writer.close()
+
+
+def compress_npy(npy_file, chunk_rows=1000, max_rel_error=1e-6, remove=True):
+    # convert a .npy file into a compressed dataset and return its path
+    path = npy_file[:-len(".npy")] + COMPRESSED_EXT if npy_file.endswith(".npy") else npy_file + COMPRESSED_EXT
+    save_dataset(path, np.load(npy_file, mmap_mode='r'), chunk_rows=chunk_rows, max_rel_error=max_rel_error)
+    if remove:
+        os.remove(npy_file)
+    return path
+
+
+def load_array(file_name, lazy=False):
+    # load a .npy file or a compressed dataset (if lazy, .npy files are memory-mapped and
+    # compressed datasets are returned as a CompressedDataset to be read by row ranges)
+    if os.path.isdir(file_name):
+        dataset = CompressedDataset(file_name)
+        if lazy:
+            return dataset
+        return dataset.read()
+    if lazy:
+        return np.load(file_name, mmap_mode='r')
+    return np.load(file_name)
@@ -0,0 +1,41 @@
+# Functions for running jobs in parallel processes with a limited number of threads each
+# Used by training_utilities and the 4.predict_*.py scripts (TensorFlow is not imported here)
+import os
+import sys
+import multiprocessing
+
+
+def thread_env(n_threads):
+    # environment variables read by TensorFlow and the BLAS/OpenMP libraries at import
+    n = str(n_threads)
+    return {'OMP_NUM_THREADS': n,
+            'MKL_NUM_THREADS': n,
+            'OPENBLAS_NUM_THREADS': n,
+            'TF_NUM_INTRAOP_THREADS': n,
+            'TF_NUM_INTEROP_THREADS': str(min(2, n_threads))}
+
+
+def set_thread_budget(n_threads):
+    # must be called before TensorFlow runs any operation in the process
+    # (processes that did not import TensorFlow are limited by the variables of thread_env)
+    if "tensorflow" in sys.modules:
+        tf = sys.modules["tensorflow"]
+        tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(min(2, n_threads))
+
+
+def map_with_thread_budget(func, jobs, n_workers, n_threads):
+    # same as Pool(n_workers).map(func, jobs), with each worker limited to n_threads threads
+    # workers are spawned so that the thread settings apply when TensorFlow or NumPy are imported
+    ctx = multiprocessing.get_context("spawn")
+    env = os.environ.copy()
+    os.environ.update(thread_env(n_threads))
+    try:
+        pool = ctx.Pool(n_workers, initializer=set_thread_budget, initargs=(n_threads,))
+    finally:
+        os.environ.clear()
+        os.environ.update(env)
+    results = pool.map(func, jobs, chunksize=1)
+    pool.close()
+    pool.join()
+    return results
@@ -0,0 +1,220 @@
+# Local prediction server: keeps the trained models loaded and serves predictions over HTTP (localhost)
+# Used by the 4.predict_*.py scripts with serve_predictions = True
+#
+# GET  /models   names of the loaded models
+# POST /predict  JSON with either
+#                  "features": empirical features of one or more replicates, shape (t, f) or (replicate, t, f)
+#                  "inputs": list of inputs read by the script (e.g. {"data_wd": path, "replicate": 1})
+#                and optionally "n_predictions" (default 1), "dropout" (default true),
+#                "quantiles" (default [0.025, 0.5, 0.975]) and "return_predictions" (default true)
+#                returns the predicted diversity (model, replicate, draw, time bin; from recent to old)
+#                with its mean and quantiles per time bin across models, replicates and draws
+#                (requests with invalid settings or features not matching the models return 400)
+import json
+import time
+import queue
+import threading
+import traceback
+import urllib.request
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import prediction_utilities as pu
+
+
+class PredictionRequest():
+    def __init__(self, features, n_predictions, dropout):
+        self.features = features  # array of shape (replicate, t, f)
+        self.n_predictions = n_predictions
+        self.dropout = dropout
+        self.done = threading.Event()
+        self.predictions = None
+        self.error = None
+
+
+class BatchPredictor():
+    # Runs the requests of concurrent clients together: the requests received within batch_wait
+    # seconds of each other (up to max_batch replicates) are predicted with one pu.predict_models call
+    # All predictions run in a single thread, so the models are never called concurrently
+    def __init__(self, models, batch_wait=0.01, max_batch=1000, batch_size=1000):
+        self.models = models  # {name: (model, feature_rescaler)}
+        self.batch_wait = batch_wait
+        self.max_batch = max_batch
+        self.batch_size = batch_size
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def predict(self, features, n_predictions=1, dropout=True):
+        # log-transformed predictions of shape (model, replicate, draw, time bin), as pu.predict_models
+        request = PredictionRequest(features, n_predictions, dropout)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.predictions
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        if batch[0] is None:
+            return None
+        n_replicates = len(batch[0].features)
+        deadline = time.time() + self.batch_wait
+        while n_replicates < self.max_batch:
+            try:
+                request = self.requests.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)
+                break
+            batch.append(request)
+            n_replicates += len(request.features)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            groups = {}  # only requests with the same settings and feature shape are predicted together
+            for request in batch:
+                key = (request.n_predictions, request.dropout, request.features.shape[1:])
+                groups.setdefault(key, []).append(request)
+            for (n_predictions, dropout, _), requests in groups.items():
+                try:
+                    features = np.concatenate([request.features for request in requests])
+                    pred = pu.predict_models(list(self.models.values()), [features], n_predictions=n_predictions,
+                                             dropout=dropout, batch_size=self.batch_size)
+                    i = 0
+                    for request in requests:
+                        request.predictions = pred[:, i:i + len(request.features)]
+                        i += len(request.features)
+                except Exception:
+                    for request in requests:
+                        request.error = traceback.format_exc()
+                for request in requests:
+                    request.done.set()
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+
+def check_input_shape(features, models):
+    # the features must match the input shape of all models (dimensions left undefined (None) match any size)
+    for name in models:
+        model_shape = getattr(models[name][0], 'input_shape', None)
+        if model_shape is None:
+            continue
+        model_shape = tuple(model_shape[1:])
+        if len(model_shape) != len(features.shape) - 1 or np.any(
+                [m is not None and m != f for m, f in zip(model_shape, features.shape[1:])]):
+            raise ValueError("Features of shape %s do not match the input shape of model %s: %s"
+                             % (features.shape[1:], name, model_shape))
+
+
+def request_features(body, load_input=None, lock=None, models=None):
+    # features of all replicates in a request, as an array of shape (replicate, t, f)
+    # (checked against the input shape of the models, if given)
+    if "features" in body:
+        features = [np.asarray(body["features"], dtype=np.float32)]
+    elif "inputs" in body:
+        if load_input is None:
+            raise ValueError("This server only accepts features")
+        with lock:
+            features = [np.asarray(load_input(item), dtype=np.float32) for item in body["inputs"]]
+    else:
+        raise ValueError("The request must include 'features' or 'inputs'")
+    features = np.concatenate([f.reshape((-1,) + f.shape[-2:]) for f in features])
+    if models is not None:
+        check_input_shape(features, models)
+    return features
+
+
+def request_options(body):
+    # prediction settings of a request, with their default values
+    opt = {'n_predictions': int(body.get("n_predictions", 1)),
+           'dropout': bool(body.get("dropout", True)),
+           'quantiles': [float(q) for q in body.get("quantiles", (0.025, 0.5, 0.975))],
+           'return_predictions': bool(body.get("return_predictions", True))}
+    if opt['n_predictions'] < 1:
+        raise ValueError("n_predictions must be at least 1")
+    if np.any([q < 0 or q > 1 for q in opt['quantiles']]):
+        raise ValueError("quantiles must be between 0 and 1")
+    return opt
+
+
+def summarize_predictions(pred, model_names, quantiles=(0.025, 0.5, 0.975), return_predictions=True):
+    div = np.exp(pred) - 1
+    samples = div.reshape(-1, div.shape[-1])
+    res = {'models': model_names,
+           'shape': list(div.shape),
+           'mean': np.mean(samples, axis=0).tolist(),
+           'quantiles': {str(q): np.quantile(samples, q, axis=0).tolist() for q in quantiles}}
+    if return_predictions:
+        res['predictions'] = div.tolist()
+    return res
+
+
+def make_handler(predictor, load_input=None):
+    input_lock = threading.Lock()  # input files are parsed one request at a time
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, res):
+            out = json.dumps(res).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def do_GET(self):
+            if self.path == "/models":
+                self.send_json(200, {'models': list(predictor.models)})
+            else:
+                self.send_json(404, {'error': "Unknown path: %s" % self.path})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self.send_json(404, {'error': "Unknown path: %s" % self.path})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                opt = request_options(body)
+                features = request_features(body, load_input, input_lock, models=predictor.models)
+            except Exception as e:
+                self.send_json(400, {'error': "%s: %s" % (type(e).__name__, e)})
+                return
+            try:
+                pred = predictor.predict(features, n_predictions=opt['n_predictions'], dropout=opt['dropout'])
+            except RuntimeError as e:
+                self.send_json(500, {'error': str(e)})
+                return
+            self.send_json(200, summarize_predictions(pred, list(predictor.models), quantiles=opt['quantiles'],
+                                                      return_predictions=opt['return_predictions']))
+
+    return PredictionHandler
+
+
+def serve(models, load_input=None, host="127.0.0.1", port=8765, batch_wait=0.01, max_batch=1000):
+    # models: {name: (model, feature_rescaler)}, load_input: function returning the features of an
+    # item in the "inputs" of a request (e.g. reading the input files with dd.prep_dd_input)
+    # runs until interrupted (Ctrl+C)
+    predictor = BatchPredictor(models, batch_wait=batch_wait, max_batch=max_batch)
+    server = ThreadingHTTPServer((host, port), make_handler(predictor, load_input))
+    print("Serving predictions of %s models on http://%s:%s" % (len(models), host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        predictor.close()
+
+
+def request_predictions(body, url="http://127.0.0.1:8765"):
+    # client: sends a request to a running server and returns its response
+    req = urllib.request.Request(url + "/predict", data=json.dumps(body).encode(),
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req) as response:
+        return json.loads(response.read())
@@ -0,0 +1,411 @@
+# Functions for running DeepDive predictions on the empirical data
+# Used by the 4.predict_*.py scripts
+import os
+import json
+import hashlib
+import pickle as pk
+import numpy as np
+import pandas as pd
+
+
+def file_fingerprint(file_name):
+    stat = os.stat(file_name)
+    return [os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns]
+
+
+def _to_json(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return repr(obj)
+
+
+class InputCache():
+    # Caches the output of dd.prep_dd_input (features and info of each replicate) in memory and,
+    # if cache_dir is set, on disk so that the empirical input files are parsed once per replicate
+    # and reused across models and across runs of the script
+    # Entries are keyed on the arguments and on path, size and modification time of the input files
+    # (time bins, locality file and all files in the taxon directory), so editing or regenerating
+    # the input data invalidates them
+    def __init__(self, prep_function, cache_dir=None):
+        self.prep_function = prep_function
+        self.cache_dir = cache_dir
+        self.memory = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def input_files(self, data_wd, kwargs):
+        files = [os.path.join(data_wd, kwargs['bin_duration_file']),
+                 os.path.join(data_wd, kwargs['locality_dir'], kwargs['locality_file'])]
+        taxon_dir = os.path.join(data_wd, kwargs['taxon_dir'])
+        files += [os.path.join(taxon_dir, f) for f in sorted(os.listdir(taxon_dir))]
+        return [f for f in files if os.path.isfile(f)]
+
+    def key(self, data_wd, kwargs):
+        fingerprint = {'args': kwargs,
+                       'data_wd': os.path.abspath(data_wd),
+                       'files': [file_fingerprint(f) for f in self.input_files(data_wd, kwargs)]}
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=_to_json).encode()).hexdigest()
+
+    def prep_dd_input(self, data_wd, **kwargs):
+        # same arguments and output as dd.prep_dd_input
+        key = self.key(data_wd, kwargs)
+        if key in self.memory:
+            return self.memory[key]
+        cache_file = None
+        if self.cache_dir is not None:
+            cache_file = os.path.join(self.cache_dir, "prep_dd_input_%s.pkl" % key)
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, "rb") as f:
+                res = pk.load(f)
+        else:
+            res = self.prep_function(data_wd, **kwargs)
+            if cache_file is not None:
+                with open(cache_file + ".tmp", "wb") as f:
+                    pk.dump(res, f)
+                os.replace(cache_file + ".tmp", cache_file)
+        self.memory[key] = res
+        return res
+
+
+def rescale_features(feature_rescaler, features):
+    # older models were saved with a single rescaling factor instead of a FeatureRescaler, models
+    # trained with a streaming rescaler with a scale array or a dictionary of scale and shift arrays
+    if hasattr(feature_rescaler, 'feature_rescale'):
+        return feature_rescaler.feature_rescale(features)
+    if isinstance(feature_rescaler, dict):
+        return features * feature_rescaler['scale'] + feature_rescaler['shift']
+    return features * feature_rescaler
+
+
+def predict_ensemble(features_list, model, feature_rescaler, n_predictions=1, dropout=True, batch_size=1000):
+    # predictions of one model for all replicates (list of features as returned by dd.prep_dd_input)
+    # and n_predictions MC dropout draws, computed in a few large forward passes instead of one
+    # dd.predict call per replicate; returns an array of shape (replicate, draw, time bin) in the same
+    # (log-transformed) scale as dd.predict
+    x = np.concatenate([np.asarray(f).reshape((-1,) + np.shape(f)[-2:]) for f in features_list])
+    x = rescale_features(feature_rescaler, x).astype(np.float32)
+    n_replicates = len(x)
+    if hasattr(model, 'sample'):
+        # NumPy kernel: the layers before the first dropout are not repeated for each draw
+        step = max(1, batch_size // n_predictions)
+        return np.concatenate([model.sample(x[i:i + step], n_predictions, training=dropout).reshape(
+            len(x[i:i + step]), n_predictions, -1) for i in range(0, n_replicates, step)])
+    # each replicate repeated n_predictions times (draws are independent through dropout)
+    x = np.repeat(x, n_predictions, axis=0)
+    pred = np.empty((len(x), x.shape[1]), dtype=np.float32)
+    for i in range(0, len(x), batch_size):
+        pred[i:i + batch_size] = np.asarray(model(x[i:i + batch_size], training=dropout)).reshape(
+            len(x[i:i + batch_size]), -1)
+    return pred.reshape(n_replicates, n_predictions, -1)
+
+
+def predict_models(models, features_list, n_predictions=1, dropout=True, batch_size=1000):
+    # models: list of (model, feature_rescaler); returns an array of shape (model, replicate, draw, time bin)
+    return np.stack([predict_ensemble(features_list, model, feature_rescaler, n_predictions=n_predictions,
+                                      dropout=dropout, batch_size=batch_size)
+                     for model, feature_rescaler in models])
+
+
+def load_settings_strata(settings_file, keys, n_strata=4):
+    # assigns each test simulation to one of n_strata quantile bins of the simulation settings in keys
+    # (settings saved by the simulation script, one dictionary per simulation in simulation order)
+    # returns {setting: array with the stratum of each simulation}
+    with open(settings_file, "rb") as f:
+        sim_settings = pk.load(f)
+    strata = {}
+    for key in keys:
+        values = np.array([np.mean(s[key]) for s in sim_settings], dtype=float)
+        edges = np.unique(np.quantile(values, np.linspace(0, 1, n_strata + 1)))
+        names = np.array(["%s-%s" % (np.round(edges[i], 3), np.round(edges[i + 1], 3))
+                          for i in range(len(edges) - 1)] or [str(np.round(edges[0], 3))])
+        indx = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(names) - 1)
+        strata[key] = names[indx]
+    return strata
+
+
+def evaluate_test_set(model, feature_rescaler, features, labels, label_transform, strata=None,
+                      n_predictions=100, interval=0.95, batch_size=1000):
+    # test set metrics accumulated batch by batch in a single pass (features and labels can be
+    # memory-mapped arrays or compressed datasets): MSE and bias of the prediction (without dropout)
+    # and coverage of the MC dropout prediction interval (n_predictions draws), for each time bin,
+    # over the whole test set and within each stratum (see load_settings_strata)
+    # returns a data frame with one row per setting, stratum and time bin
+    strata = strata or {}
+    for key in strata:
+        if len(strata[key]) != len(features):
+            raise ValueError("The settings of %s simulations do not match the %s test simulations (setting: %s), "
+                             "the settings file must come from the same run as the test set"
+                             % (len(strata[key]), len(features), key))
+    q = [(1 - interval) / 2, 1 - (1 - interval) / 2]
+    if n_predictions < 2 / (1 - interval):
+        # too few draws to estimate the interval quantiles: the coverage is that of the range of the draws
+        print("Warning: %s MC dropout draws are too few to estimate the %s interval (at least %s are needed)"
+              % (n_predictions, interval, int(np.ceil(2 / (1 - interval)))))
+    step = max(1, batch_size // n_predictions)  # simulations per forward pass of the MC dropout draws
+    sums = {}  # (setting, stratum): simulations, squared errors, errors and interval hits per time bin
+    for i in range(0, len(features), batch_size):
+        x = rescale_features(feature_rescaler, np.asarray(features[i:i + batch_size])).astype(np.float32)
+        y = np.asarray(label_transform(np.asarray(labels[i:i + batch_size]))).reshape(len(x), -1)
+        err = np.asarray(model(x, training=False)).reshape(y.shape) - y
+        if hasattr(model, 'sample'):
+            draws = np.concatenate([model.sample(x[j:j + step], n_predictions, training=True).reshape(
+                len(x[j:j + step]), n_predictions, -1) for j in range(0, len(x), step)])
+        else:
+            draws = np.concatenate([np.asarray(model(np.repeat(x[j:j + step], n_predictions, axis=0),
+                                                     training=True)).reshape(len(x[j:j + step]), n_predictions, -1)
+                                    for j in range(0, len(x), step)])
+        lo, hi = np.quantile(draws, q, axis=1)
+        hit = (y >= lo) & (y <= hi)
+        groups = [("all", np.full(len(x), "all"))] + [(key, strata[key][i:i + len(x)]) for key in strata]
+        for setting, stratum in groups:
+            for s in np.unique(stratum):
+                rows = stratum == s
+                acc = sums.setdefault((setting, s), np.zeros((4, y.shape[1])))
+                acc[0] += np.sum(rows)
+                acc[1] += np.sum(err[rows] ** 2, axis=0)
+                acc[2] += np.sum(err[rows], axis=0)
+                acc[3] += np.sum(hit[rows], axis=0)
+    res = []
+    for (setting, s), acc in sums.items():
+        for time_bin in range(acc.shape[1]):
+            n = acc[0, time_bin]
+            res.append([setting, s, time_bin, int(n), acc[1, time_bin] / n, acc[2, time_bin] / n,
+                        acc[3, time_bin] / n])
+    return pd.DataFrame(res, columns=["setting", "stratum", "time_bin", "n_simulations", "MSE", "bias",
+                                      "coverage"])
+
+
+# NumPy inference kernel: trained models are exported with export_rnn and run with NumpyRNN,
+# which reproduces the forward pass of the Keras model (including MC dropout) without TensorFlow
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 0.5 * (1 + np.tanh(0.5 * x)),
+    'softplus': lambda x: np.logaddexp(0, x),
+    'exponential': np.exp,
+    'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    'swish': lambda x: x * 0.5 * (1 + np.tanh(0.5 * x)),
+}
+
+
+def _activation_name(activation):
+    name = activation if isinstance(activation, str) else getattr(activation, '__name__', str(activation))
+    if name not in ACTIVATIONS:
+        raise ValueError("Activation function not supported by the NumPy kernel: %s" % name)
+    return name
+
+
+def _export_lstm(layer, weights, prefix):
+    config = layer.get_config()
+    if not config.get('use_bias', True):
+        raise ValueError("LSTM layers without bias are not supported by the NumPy kernel")
+    kernel, recurrent_kernel, bias = layer.get_weights()
+    weights[prefix + "kernel"] = kernel
+    weights[prefix + "recurrent_kernel"] = recurrent_kernel
+    weights[prefix + "bias"] = bias
+    return {'type': 'lstm', 'units': config['units'], 'weights': prefix,
+            'activation': _activation_name(config['activation']),
+            'recurrent_activation': _activation_name(config['recurrent_activation']),
+            'return_sequences': config['return_sequences'],
+            'go_backwards': config.get('go_backwards', False),
+            'dropout': config.get('dropout', 0), 'recurrent_dropout': config.get('recurrent_dropout', 0)}
+
+
+def _export_dense(layer, weights, prefix):
+    config = layer.get_config()
+    w = layer.get_weights()
+    weights[prefix + "kernel"] = w[0]
+    if config.get('use_bias', True):
+        weights[prefix + "bias"] = w[1]
+    return {'type': 'dense', 'weights': prefix, 'use_bias': config.get('use_bias', True),
+            'activation': _activation_name(config['activation'])}
+
+
+def _export_dropout(layer):
+    if layer.get_config().get('noise_shape') is not None:
+        raise ValueError("Dropout layers with noise_shape are not supported by the NumPy kernel")
+    return {'type': 'dropout', 'rate': layer.rate}
+
+
+def export_layers(model):
+    # list of layer specifications and dictionary of weights of a (sequential) Keras model
+    spec, weights = [], {}
+    for i, layer in enumerate(model.layers):
+        layer_type = layer.__class__.__name__
+        prefix = "layer%s_" % i
+        if layer_type == "InputLayer":
+            continue
+        elif layer_type == "Bidirectional":
+            spec.append({'type': 'bidirectional', 'merge_mode': layer.merge_mode,
+                         'forward': _export_lstm(layer.forward_layer, weights, prefix + "forward_"),
+                         'backward': _export_lstm(layer.backward_layer, weights, prefix + "backward_")})
+        elif layer_type == "LSTM":
+            spec.append(_export_lstm(layer, weights, prefix))
+        elif layer_type == "TimeDistributed" and layer.layer.__class__.__name__ in ["Dense", "Dropout"]:
+            # a dense layer applied to each time bin is a dense layer on the last axis
+            # (dropout masks are sampled for each time bin and unit in both cases)
+            if layer.layer.__class__.__name__ == "Dense":
+                spec.append(_export_dense(layer.layer, weights, prefix))
+            else:
+                spec.append(_export_dropout(layer.layer))
+        elif layer_type == "Dense":
+            spec.append(_export_dense(layer, weights, prefix))
+        elif layer_type == "Dropout":
+            spec.append(_export_dropout(layer))
+        else:
+            raise ValueError("Layer not supported by the NumPy kernel: %s (%s)" % (layer.name, layer_type))
+    return spec, weights
+
+
+class AffineRescaler():
+    # feature rescaling written as scale * features + shift (per time bin and feature)
+    def __init__(self, scale, shift):
+        self.scale = scale
+        self.shift = shift
+
+    def feature_rescale(self, features):
+        return np.asarray(features) * self.scale + self.shift
+
+
+def affine_rescaler(feature_rescaler, input_shape, rtol=1e-5):
+    # the rescalers of dd.FeatureRescaler (and the single factors of older models) are affine
+    # functions of the features: scale and shift are obtained from rescaling 0 and 1 and checked
+    # on random features
+    shift = np.asarray(rescale_features(feature_rescaler, np.zeros((1,) + tuple(input_shape))), dtype=float)[0]
+    scale = np.asarray(rescale_features(feature_rescaler, np.ones((1,) + tuple(input_shape))), dtype=float)[0] - shift
+    x = np.random.default_rng(0).random((10,) + tuple(input_shape)) * 100
+    if not np.allclose(rescale_features(feature_rescaler, x), x * scale + shift, rtol=rtol, atol=rtol):
+        raise ValueError("The feature rescaler is not an affine function of the features")
+    return AffineRescaler(scale, shift)
+
+
+def export_rnn(model, feature_rescaler, file_name, history=None):
+    # saves a trained model (as returned by dd.load_rnn_model) and its feature rescaler in a single
+    # .npz file that can be loaded with load_numpy_rnn without importing TensorFlow
+    spec, weights = export_layers(model)
+    input_shape = tuple(model.input_shape[1:])
+    rescaler = affine_rescaler(feature_rescaler, input_shape)
+    info = {'layers': spec, 'input_shape': input_shape}
+    if history is not None:
+        info['history'] = {key: np.asarray(history[key]).tolist() for key in history}
+    weights = {key: np.asarray(weights[key], dtype=np.float32) for key in weights}
+    np.savez_compressed(file_name, info=np.array(json.dumps(info)),
+                        rescaler_scale=rescaler.scale.astype(np.float32),
+                        rescaler_shift=rescaler.shift.astype(np.float32), **weights)
+    return file_name
+
+
+def load_numpy_rnn(file_name, seed=None):
+    # same output as dd.load_rnn_model: history (None if not exported), model and feature rescaler
+    with np.load(file_name) as data:
+        info = json.loads(str(data['info']))
+        weights = {key: data[key] for key in data.files if key.startswith("layer")}
+        rescaler = AffineRescaler(data['rescaler_scale'], data['rescaler_shift'])
+    model = NumpyRNN(info['layers'], weights, input_shape=info['input_shape'], seed=seed)
+    return info.get('history'), model, rescaler
+
+
+class NumpyRNN():
+    # batched forward pass of an exported model; model(x, training=True) samples the dropout masks
+    # as Keras does, so it can replace the Keras model in predict_ensemble and evaluate_test_set
+    def __init__(self, layers, weights, input_shape=None, seed=None):
+        self.layers = layers
+        self.weights = weights
+        self.input_shape = (None,) + tuple(input_shape) if input_shape is not None else None
+        self.rng = np.random.default_rng(seed)
+
+    def __call__(self, x, training=False):
+        return self.forward(x, self.layers, training)
+
+    def first_dropout_layer(self):
+        # index of the first layer applying dropout (len(layers) if none)
+        for i, layer in enumerate(self.layers):
+            if layer['type'] == 'dropout' and layer['rate'] > 0:
+                return i
+            lstm_layers = [layer['forward'], layer['backward']] if layer['type'] == 'bidirectional' else [layer]
+            if layer['type'] in ['lstm', 'bidirectional'] and any(
+                    l['dropout'] > 0 or l['recurrent_dropout'] > 0 for l in lstm_layers):
+                return i
+        return len(self.layers)
+
+    def sample(self, x, n_predictions=1, training=True):
+        # n_predictions MC dropout draws for each input (shape: input, draw, ...): the layers before
+        # the first dropout are deterministic, so they are computed once and shared by all draws
+        start = self.first_dropout_layer() if training else len(self.layers)
+        h = np.repeat(self.forward(x, self.layers[:start]), n_predictions, axis=0)
+        out = self.forward(h, self.layers[start:], training)
+        return out.reshape((len(x), n_predictions) + out.shape[1:])
+
+    def forward(self, x, layers, training=False):
+        x = np.asarray(x, dtype=np.float32)
+        for layer in layers:
+            if layer['type'] == 'bidirectional':
+                forward = self.lstm(x, layer['forward'], training)
+                backward = self.lstm(x, layer['backward'], training)
+                if layer['backward']['return_sequences']:
+                    # as in Keras, the backward outputs are aligned with the forward time steps
+                    backward = backward[:, ::-1]
+                x = self.merge(forward, backward, layer['merge_mode'])
+            elif layer['type'] == 'lstm':
+                x = self.lstm(x, layer, training)
+            elif layer['type'] == 'dense':
+                x = x @ self.weights[layer['weights'] + "kernel"]
+                if layer['use_bias']:
+                    x = x + self.weights[layer['weights'] + "bias"]
+                x = ACTIVATIONS[layer['activation']](x)
+            elif layer['type'] == 'dropout' and training:
+                x = self.dropout(x, layer['rate'])
+        return x
+
+    def dropout(self, x, rate):
+        if rate <= 0:
+            return x
+        return x * (self.rng.random(x.shape) >= rate) / np.float32(1 - rate)
+
+    @staticmethod
+    def merge(forward, backward, merge_mode):
+        if merge_mode == 'concat':
+            return np.concatenate([forward, backward], axis=-1)
+        elif merge_mode == 'sum':
+            return forward + backward
+        elif merge_mode == 'ave':
+            return (forward + backward) / 2
+        elif merge_mode == 'mul':
+            return forward * backward
+        raise ValueError("Merge mode not supported by the NumPy kernel: %s" % merge_mode)
+
+    def lstm(self, x, layer, training=False):
+        kernel = self.weights[layer['weights'] + "kernel"]
+        recurrent_kernel = self.weights[layer['weights'] + "recurrent_kernel"]
+        bias = self.weights[layer['weights'] + "bias"]
+        activation = ACTIVATIONS[layer['activation']]
+        recurrent_activation = ACTIVATIONS[layer['recurrent_activation']]
+        units = layer['units']
+        if layer['go_backwards']:
+            x = x[:, ::-1]
+        if training:
+            # one dropout mask per sequence, shared across time steps
+            x = x * self.dropout(np.ones((len(x), 1, x.shape[-1]), dtype=np.float32), layer['dropout'])
+        # input contributions of all time steps in a single product, gates ordered as i, f, c, o
+        z_x = x @ kernel + bias
+        h = np.zeros((len(x), units), dtype=np.float32)
+        c = np.zeros((len(x), units), dtype=np.float32)
+        h_mask = None
+        if training and layer['recurrent_dropout'] > 0:
+            h_mask = self.dropout(np.ones((len(x), units), dtype=np.float32), layer['recurrent_dropout'])
+        outputs = np.empty((len(x), x.shape[1], units), dtype=np.float32)
+        for t in range(x.shape[1]):
+            z = z_x[:, t] + (h if h_mask is None else h * h_mask) @ recurrent_kernel
+            i = recurrent_activation(z[:, :units])
+            f = recurrent_activation(z[:, units:2 * units])
+            g = activation(z[:, 2 * units:3 * units])
+            o = recurrent_activation(z[:, 3 * units:])
+            c = f * c + i * g
+            h = o * activation(c)
+            outputs[:, t] = h
+        if layer['return_sequences']:
+            return outputs
+        return h
@@ -0,0 +1,15 @@
+# Entry point of the processes simulating on the fly for training_utilities.SimulationStream
+# Started as a new Python process (not with multiprocessing, which would import the training script
+# again in each worker, with TensorFlow and the full deepdive package): only this file, the
+# simulation utilities and the 2.simulate_*.py script providing simulate() are loaded
+# usage: python simulation_stream_worker.py <address> <script_file> <seed> <first_sim> <step>
+#        (the authentication key of the connection is read from stdin, as hex)
+import sys
+from multiprocessing.connection import Client
+
+if __name__ == "__main__":
+    # connect first, so that the training process is never left waiting for a worker that failed
+    conn = Client(sys.argv[1], authkey=bytes.fromhex(sys.stdin.readline().strip()))
+    import simulation_utilities as su
+    su.stream_worker(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]), conn)
+    conn.close()
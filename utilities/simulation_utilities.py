@@ -0,0 +1,538 @@
+# Functions for running large DeepDive simulation campaigns
+# Used by the 2.simulate_*.py scripts
+import os
+import re
+import sys
+import time
+import json
+import types
+import shutil
+import traceback
+import hashlib
+import pkgutil
+import resource
+import importlib
+import pickle as pk
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+# functions and classes of the deepdive package used to run simulations
+SIMULATION_API = ['bd_simulator', 'fossil_simulator', 'extract_sim_features', 'set_area_constraints',
+                  'print_update', 'save_pkl']
+HEAVY_MODULES = ['tensorflow', 'keras', 'matplotlib']
+_api_info = {}
+
+
+class CampaignWriter():
+    # Writes each simulation directly into the memory-mapped campaign arrays at its row index,
+    # so that simulated data are never sent back to the main process or copied
+    def __init__(self, output_dir, prefix):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.arrays = {key: np.load(campaign_file(output_dir, prefix, key), mmap_mode='r+')
+                       for key in ['features', 'labels', 'seed_index']}
+        self._settings = []
+
+    def add(self, sim_index, features, labels, seed, settings=None):
+        self.arrays['features'][sim_index] = features
+        self.arrays['labels'][sim_index] = labels
+        self.arrays['seed_index'][sim_index] = [sim_index, seed]
+        if settings is not None:
+            self._settings.append(settings)
+
+    def close(self, task):
+        # flush the written rows to disk and return a completion notice for the main process
+        for key in self.arrays:
+            self.arrays[key].flush()
+        self.arrays = {}
+        record = {'name': task['name'], 'first_sim': task['first_sim'], 'n_sims': task['n_sims']}
+        if len(self._settings):
+            record['settings'] = "%s_settings.pkl" % task['name']
+            with open(os.path.join(self.output_dir, record['settings'] + ".tmp"), "wb") as f:
+                pk.dump(self._settings, f)
+            os.replace(os.path.join(self.output_dir, record['settings'] + ".tmp"),
+                       os.path.join(self.output_dir, record['settings']))
+        return record
+
+
+class AreaConstraints():
+    # Samples the ages at which areas appear for each simulation and builds the masks passed to
+    # fossil_simulator.set_carrying_capacity_multiplier with broadcasting (replaces dd.set_area_constraints)
+    # start_ranges: list of [area_ids, [min_age, max_age]], areas listed together share the same age
+    # areas without a range exist throughout
+    def __init__(self, n_areas, time_bins, start_ranges, compact=True):
+        self.n_areas = n_areas
+        self.time_bins = np.asarray(time_bins)
+        self.n_time_bins = len(time_bins) - 1
+        self.mid_time_bins = self.time_bins[:-1] + 0.5 * np.diff(self.time_bins)
+        self.start_ranges = start_ranges
+        self.compact = compact
+
+    def sample_area_tbl(self, rng):
+        # (rows: n_areas, cols: [area_id, start, end]), -1: start at the beginning or end at time 0
+        area_tbl = np.ones((self.n_areas, 3))
+        area_tbl[:, 0] = np.arange(self.n_areas)
+        area_tbl[:, 1:] = -1
+        for area_ids, age_range in self.start_ranges:
+            area_tbl[area_ids, 1] = rng.uniform(age_range[0], age_range[1])
+        return area_tbl
+
+    def masks(self, sp_x, area_tbl):
+        area_tbl = np.asarray(area_tbl)
+        start = np.where(area_tbl[:, 1] > 0, area_tbl[:, 1], np.inf)
+        end = np.where(area_tbl[:, 2] > 0, area_tbl[:, 2], -np.inf)
+        # area x time: the area exists at the mid point of the time bin
+        area_time = (self.mid_time_bins[None, :] <= start[:, None]) & (self.mid_time_bins[None, :] >= end[:, None])
+        # species x area: a species can only originate in areas that exist at its origination time
+        m_species_origin = (sp_x[:, 0][:, None] <= start[None, :]) & (sp_x[:, 0][:, None] >= end[None, :])
+        n_species = sp_x.shape[0]
+        if self.compact:
+            # boolean masks, the species x area x time mask is a read-only view of the area x time mask
+            return m_species_origin, np.broadcast_to(area_time, (n_species, self.n_areas, self.n_time_bins))
+        m_sp_area_time = np.repeat(area_time[None, :, :], n_species, axis=0).astype(float)
+        return m_species_origin.astype(float), m_sp_area_time
+
+    def check(self, set_area_constraints, sp_x, area_tbl):
+        # compare the masks with those of dd.set_area_constraints for one simulation
+        c1, c2 = set_area_constraints(sp_x=sp_x,
+                                      n_time_bins=self.n_time_bins,
+                                      area_tbl=pd.DataFrame(area_tbl),
+                                      mid_time_bins=self.mid_time_bins)
+        m1, m2 = self.masks(sp_x, area_tbl)
+        return np.array_equal(np.asarray(c1, dtype=float), m1.astype(float)) and \
+            np.array_equal(np.asarray(c2, dtype=float), m2.astype(float))
+
+    def check_compact(self, simulate, rseed):
+        # run one simulation with the compact (boolean, read-only) masks and one with dense, writable
+        # float masks: the fossil simulator should return the same features and labels with both
+        compact = self.compact
+        try:
+            self.compact = False
+            features, labels = simulate(rseed)[:2]
+            self.compact = True
+            try:
+                compact_features, compact_labels = simulate(rseed)[:2]
+            except (ValueError, TypeError) as e:
+                # e.g. the simulator writes into the masks
+                print("Simulation with compact area masks failed: %s" % e)
+                return False
+        finally:
+            self.compact = compact
+        return np.array_equal(np.asarray(features), np.asarray(compact_features)) and \
+            np.array_equal(np.asarray(labels), np.asarray(compact_labels))
+
+
+def heavy_submodules(path):
+    # names of the deepdive submodules importing TensorFlow, Keras or matplotlib, either directly or
+    # through other deepdive submodules or the package __init__ (modules without source are included)
+    heavy_import = re.compile(r"^\s*(import|from)\s+(%s)\b" % "|".join(HEAVY_MODULES), re.MULTILINE)
+    package_import = re.compile(r"^\s*(?:from\s+(?:\.|deepdive\.)(\w+)\s+import|import\s+deepdive\.(\w+)|"
+                                r"from\s+(?:\.|deepdive)\s+import\s+(\w+))", re.MULTILINE)
+    submodules = [module_info.name for module_info in pkgutil.iter_modules(path)]
+    heavy = {"__init__"}
+    imports = {}
+    for module_info in pkgutil.iter_modules(path):
+        try:
+            with open(os.path.join(module_info.module_finder.path, module_info.name + ".py")) as f:
+                source = f.read()
+        except OSError:
+            heavy.add(module_info.name)
+            continue
+        if heavy_import.search(source):
+            heavy.add(module_info.name)
+        # names imported from the package itself (not from a submodule) come from the package __init__
+        imports[module_info.name] = {name if name in submodules else "__init__"
+                                     for groups in package_import.findall(source) for name in groups if name}
+        if re.search(r"^\s*import\s+deepdive\s*$", source, re.MULTILINE):
+            imports[module_info.name].add("__init__")
+    n_heavy = 0
+    while n_heavy != len(heavy):
+        n_heavy = len(heavy)
+        heavy.update([name for name in imports if imports[name] & heavy])
+    return heavy
+
+
+def load_deepdive_functions(names=SIMULATION_API):
+    # Import only the deepdive submodules providing the given functions, without running the package
+    # __init__ (which loads the TensorFlow/Keras modelling stack and matplotlib).
+    # The partial package is only registered in sys.modules while its submodules are imported, so a
+    # later "import deepdive" loads the full package.
+    # Falls back to the full package if the functions cannot be found this way.
+    t0 = time.time()
+    spec = importlib.util.find_spec("deepdive")
+    api = {}
+    new_heavy_modules = []
+    if "deepdive" not in sys.modules and spec is not None and spec.submodule_search_locations is not None:
+        loaded_modules = set(sys.modules)
+        pkg = types.ModuleType("deepdive")
+        pkg.__path__ = list(spec.submodule_search_locations)
+        sys.modules["deepdive"] = pkg
+        try:
+            heavy = heavy_submodules(pkg.__path__)
+            for module_info in pkgutil.iter_modules(pkg.__path__):
+                if module_info.name in heavy:
+                    continue
+                try:
+                    module = importlib.import_module("deepdive." + module_info.name)
+                except ImportError:
+                    continue
+                for name in names:
+                    if name not in api and hasattr(module, name):
+                        api[name] = getattr(module, name)
+                if len(api) == len(names):
+                    break
+        finally:
+            unload_deepdive()
+        # heavy modules imported through other packages
+        new_heavy_modules = [m for m in HEAVY_MODULES if m in sys.modules and m not in loaded_modules]
+    lightweight = len(api) == len(names) and not new_heavy_modules
+    if len(api) < len(names):
+        import deepdive
+        api = {name: getattr(deepdive, name) for name in names}
+    _api_info.update({'pid': os.getpid(), 'import_time': time.time() - t0, 'lightweight': lightweight})
+    return types.SimpleNamespace(**api)
+
+
+def unload_deepdive():
+    for module_name in [m for m in sys.modules if m == "deepdive" or m.startswith("deepdive.")]:
+        del sys.modules[module_name]
+
+
+def load_simulation_script(script_file):
+    # import a 2.simulate_*.py script as a module to use its simulate() function
+    # (the __main__ block running the simulation campaigns is not executed)
+    spec = importlib.util.spec_from_file_location("simulation_script", script_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def stream_worker(script_file, seed, first_sim, step, conn):
+    # simulate continuously (simulations first_sim, first_sim + step, ...) sending the features and
+    # labels through conn (a multiprocessing connection) until the training process closes it; sending
+    # blocks while the training process is not reading (see training_utilities.SimulationStream)
+    # the script can define check_simulator(), returning an error message if it cannot simulate as set
+    # if a simulation fails, the traceback is sent instead (as (None, traceback, None)) and the worker stops
+    module = None
+    sim_index = first_sim
+    while True:
+        try:
+            if module is None:
+                module = load_simulation_script(script_file)
+                error = module.check_simulator() if hasattr(module, "check_simulator") else None
+                if error is not None:
+                    raise RuntimeError(error)
+            features, labels = module.simulate(sim_seed(seed, sim_index))[:2]
+            item = (sim_index, np.asarray(features), np.asarray(labels))
+        except Exception:
+            item = (None, traceback.format_exc(), None)
+        try:
+            conn.send(item)
+        except (OSError, EOFError):
+            return  # connection closed by the training process
+        if item[0] is None:
+            return
+        sim_index += step
+
+
+def peak_memory_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss / 1024 ** 2  # bytes
+    return rss / 1024  # kilobytes
+
+
+def report_worker_startup():
+    # Pool initializer: print the deepdive import time and memory of each simulation worker
+    inherited = ""
+    if _api_info.get('pid') != os.getpid():
+        inherited = " (inherited from the main process)"
+    print("Worker %s: deepdive %s imported in %.2f s%s, peak memory %.1f MB, loaded: %s" % (
+        os.getpid(),
+        "simulation modules" if _api_info.get('lightweight') else "package",
+        _api_info.get('import_time', np.nan), inherited, peak_memory_mb(),
+        ", ".join([m for m in HEAVY_MODULES if m in sys.modules]) or "no TensorFlow/matplotlib"))
+
+
+def _describe(obj, depth=0):
+    # JSON-serializable description of the settings stored in an object (see settings_fingerprint)
+    if isinstance(obj, (np.random.Generator, np.random.RandomState, np.random.BitGenerator,
+                        np.random.SeedSequence)) or depth > 5:
+        return None
+    if isinstance(obj, dict):
+        return {str(k): _describe(v, depth + 1) for k, v in sorted(obj.items(), key=lambda kv: str(kv[0]))
+                if 'seed' not in str(k)}
+    if isinstance(obj, (list, tuple)):
+        return [_describe(v, depth + 1) for v in obj]
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (str, int, float, bool)) or obj is None:
+        return obj
+    if hasattr(obj, '__dict__') and not isinstance(obj, (type, types.FunctionType, types.ModuleType)):
+        return {type(obj).__name__: _describe(vars(obj), depth + 1)}
+    # memory addresses differ between runs
+    return re.sub(r" at 0x[0-9a-fA-F]+", "", repr(obj))
+
+
+def settings_fingerprint(*objects):
+    # hash of the settings stored in the simulator objects (e.g. those returned by create_sim_obj),
+    # saved with a campaign so that it is only resumed with the same simulation settings
+    # seeds and random generators are ignored, as each simulation has its own seed
+    description = json.dumps([_describe(obj) for obj in objects], sort_keys=True, default=str)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def campaign_file(output_dir, prefix, key):
+    return os.path.join(output_dir, "%s_%s.npy" % (prefix, key))
+
+
+def write_json_atomic(file_name, obj):
+    with open(file_name + ".tmp", "w") as f:
+        json.dump(obj, f, indent=1)
+    os.replace(file_name + ".tmp", file_name)
+
+
+def sim_seed(seed, sim_index):
+    # deterministic seed of a single simulation, independent of how simulations are split across CPUs
+    state = np.random.SeedSequence([seed, sim_index]).generate_state(1)[0]
+    return int(state % (2 ** 32 - 1)) + 1  # the simulators only fix the seed if > 0
+
+
+def campaign_tasks(prefix, seed, n_sims, shard_size):
+    # split a campaign of n_sims simulations into small shard-sized tasks that are handed
+    # out to the CPUs as they become available
+    tasks = []
+    for shard, first in enumerate(range(0, n_sims, shard_size)):
+        tasks.append({'name': "%s_%s" % (prefix, shard),
+                      'prefix': prefix,
+                      'seed': seed,
+                      'shard': shard,
+                      'first_sim': first,
+                      'n_sims': min(shard_size, n_sims - first)})
+    return tasks
+
+
+def create_campaign_arrays(output_dir, prefix, n_sims, features, labels):
+    # preallocate the output arrays on disk, using one simulation to set their shape and dtype
+    arrays = {'features': (features.shape, features.dtype),
+              'labels': (labels.shape, labels.dtype),
+              'seed_index': ((2,), np.int64)}
+    for key in arrays:
+        shape, dtype = arrays[key]
+        out = np.lib.format.open_memmap(campaign_file(output_dir, prefix, key), mode='w+',
+                                        dtype=dtype, shape=(n_sims,) + tuple(shape))
+        out.flush()
+        del out
+
+
+def reset_campaign(output_dir, prefix):
+    for file_name in os.listdir(output_dir):
+        if file_name.startswith(prefix + "_"):
+            os.remove(os.path.join(output_dir, file_name))
+
+
+def load_checkpoint(output_dir, prefix, campaign_info):
+    # returns the completion records of the shards written by a previous run of the same campaign
+    campaign_json = os.path.join(output_dir, prefix + "_campaign.json")
+    arrays_found = np.all([os.path.exists(campaign_file(output_dir, prefix, key))
+                           for key in ['features', 'labels', 'seed_index']])
+    if not os.path.exists(campaign_json) or not arrays_found:
+        return {}
+    with open(campaign_json) as f:
+        previous_info = json.load(f)
+    if previous_info != campaign_info:
+        raise ValueError("Simulation settings changed since the previous run (%s): remove %s "
+                         "or disable resuming to start a new campaign" % (campaign_json, output_dir))
+    completed = {}
+    log_file = os.path.join(output_dir, prefix + "_completed.jsonl")
+    if os.path.exists(log_file):
+        with open(log_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # incomplete last line of an interrupted run
+                completed[record['name']] = record
+    return completed
+
+
+def run_campaign(run_sim, simulate, output_dir, prefix, seed, n_sims, shard_size, n_cpus, resume=True,
+                 print_update=print, report_startup=False, max_sims=None, settings=None):
+    # run_sim(task) simulates one shard with a CampaignWriter and returns its completion notice
+    # simulate(rseed) returns the features and labels of a single simulation (used to size the outputs)
+    # with max_sims only the shards starting before max_sims are run (the campaign can be extended
+    # later by running it again with a larger max_sims)
+    # settings: fingerprint of the simulation settings (see settings_fingerprint), resuming a campaign
+    # simulated with different settings raises an error
+    os.makedirs(output_dir, exist_ok=True)
+    campaign_info = {'seed': seed, 'n_sims': n_sims, 'shard_size': shard_size, 'settings': settings}
+    tasks = campaign_tasks(prefix, seed=seed, n_sims=n_sims, shard_size=shard_size)
+    n_shards = len(tasks)
+    completed = {}
+    if resume:
+        completed = load_checkpoint(output_dir, prefix, campaign_info)
+    if len(completed):
+        print("Resuming simulations: %s of %s shards already completed" % (len(completed), n_shards))
+    else:
+        reset_campaign(output_dir, prefix)
+        features, labels = simulate(sim_seed(seed, 0))[:2]
+        create_campaign_arrays(output_dir, prefix, n_sims, np.asarray(features), np.asarray(labels))
+        write_json_atomic(os.path.join(output_dir, prefix + "_campaign.json"), campaign_info)
+    tasks = [t for t in tasks if t['name'] not in completed and (max_sims is None or t['first_sim'] < max_sims)]
+
+    # shards are handed out one at a time to the first available CPU
+    # the main process only receives and logs the completion notices
+    with open(os.path.join(output_dir, prefix + "_completed.jsonl"), "a") as log:
+        if report_startup:
+            pool = multiprocessing.Pool(n_cpus, initializer=report_worker_startup)
+        else:
+            pool = multiprocessing.Pool(n_cpus)
+        for record in pool.imap_unordered(run_sim, tasks):
+            log.write(json.dumps(record) + "\n")
+            log.flush()
+            os.fsync(log.fileno())
+            completed[record['name']] = record
+            print_update("%s of %s shards done" % (len(completed), n_shards))
+        pool.close()
+        pool.join()
+    print("")
+    return write_manifest(output_dir, prefix, list(completed.values()), **campaign_info)
+
+
+def write_manifest(output_dir, prefix, shards, **info):
+    shards = sorted(shards, key=lambda s: s['first_sim'])
+    manifest = {'output_dir': os.path.abspath(output_dir),
+                'prefix': prefix,
+                'n_sims': int(np.sum([s['n_sims'] for s in shards])),
+                'shards': shards}
+    for key in ['features', 'labels', 'seed_index']:
+        manifest[key] = os.path.basename(campaign_file(output_dir, prefix, key))
+    manifest.update(info)
+    manifest_file = os.path.join(output_dir, prefix + "_manifest.json")
+    write_json_atomic(manifest_file, manifest)
+    return manifest_file
+
+
+def load_manifest(manifest_file):
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    return manifest
+
+
+def completed_sims(manifest):
+    # number of simulations in the completed shards, which must be the first shards of the campaign
+    n_done = int(np.sum([shard['n_sims'] for shard in manifest['shards']]))
+    if len(manifest['shards']) and manifest['shards'][-1]['first_sim'] + manifest['shards'][-1]['n_sims'] != n_done:
+        raise ValueError("The completed shards of %s are not contiguous" % manifest['prefix'])
+    return n_done
+
+
+def finalize_campaign(manifest_file, feature_file, label_file, block_size=10000):
+    # move the completed campaign arrays to their final location (no data are copied
+    # when both paths are on the same file system)
+    manifest = load_manifest(manifest_file)
+    n_done = completed_sims(manifest)
+    shapes = []
+    for key, file_name in [('features', feature_file), ('labels', label_file)]:
+        campaign_array = os.path.join(manifest['output_dir'], manifest[key])
+        if n_done < manifest['n_sims']:
+            # campaign stopped early (adaptive budget): only the simulated rows are copied
+            arr = np.load(campaign_array, mmap_mode='r')
+            out = np.lib.format.open_memmap(file_name, mode='w+', dtype=arr.dtype, shape=(n_done,) + arr.shape[1:])
+            for i in range(0, n_done, block_size):
+                out[i:min(i + block_size, n_done)] = arr[i:min(i + block_size, n_done)]
+            out.flush()
+            del out, arr
+            os.remove(campaign_array)
+        else:
+            shutil.move(campaign_array, file_name)
+        shapes.append(np.load(file_name, mmap_mode='r').shape)
+    return shapes
+
+
+def probe_validation_mse(feature_file, label_file, n_val, n_train, probe_settings):
+    # train a probe model on simulations [n_val, n_val + n_train) and return its MSE (on normalized
+    # labels) on the first n_val simulations, which are used as a fixed validation set
+    # this is run in a spawned process so that TensorFlow is never loaded in the simulation processes
+    import deepdive as dd_full
+    features = np.load(feature_file, mmap_mode='r')
+    labels = np.load(label_file, mmap_mode='r')
+    Xt = np.asarray(features[n_val:n_val + n_train])
+    Yt = np.asarray(labels[n_val:n_val + n_train])
+    feature_rescaler = dd_full.FeatureRescaler(Xt)
+    Xt_r = feature_rescaler.feature_rescale(Xt)
+    Yt_r = dd_full.normalize_labels(Yt, rescaler=1, log=True)
+    model = dd_full.build_rnn(Xt_r,
+                              lstm_nodes=probe_settings['lstm_nodes'],
+                              dense_nodes=probe_settings['dense_nodes'],
+                              loss_f='mse',
+                              dropout_rate=probe_settings['dropout'])
+    dd_full.fit_rnn(Xt_r, Yt_r, model, verbose=0, max_epochs=1000, patience=5, batch_size=100)
+    Xv_r = feature_rescaler.feature_rescale(np.asarray(features[:n_val]))
+    Yv_r = dd_full.normalize_labels(np.asarray(labels[:n_val]), rescaler=1, log=True)
+    pred = np.asarray(model.predict(Xv_r, verbose=0)).reshape(Yv_r.shape)
+    return float(np.mean((pred - Yv_r) ** 2))
+
+
+def run_adaptive_campaign(run_sim, simulate, output_dir, prefix, seed, max_sims, shard_size, n_cpus,
+                          initial_sims, growth, min_improvement, probe_settings, learning_curve_file,
+                          n_val=None, resume=True, print_update=print, report_startup=False, settings=None):
+    # simulate the training set in growing rounds (initial_sims, initial_sims * growth, ... training
+    # simulations, up to max_sims in total): after each round a probe model is trained and the
+    # simulations stop when its validation MSE improves by less than min_improvement (relative)
+    # the first n_val simulations are a fixed validation set (and part of the final training set)
+    # the learning curve is saved to learning_curve_file, returns the manifest of the campaign
+    n_val = n_val or max(shard_size, initial_sims // 5)
+    if n_val + initial_sims > max_sims:
+        raise ValueError("The first round of simulations (%s validation + %s training simulations) exceeds the "
+                         "maximum number of simulations (%s): reduce the initial training simulations or increase "
+                         "the total number of simulations" % (n_val, initial_sims, max_sims))
+    n_train = initial_sims
+    learning_curve = []
+    ctx = multiprocessing.get_context("spawn")
+    while True:
+        manifest_file = run_campaign(run_sim, simulate, output_dir, prefix, seed=seed, n_sims=max_sims,
+                                     shard_size=shard_size, n_cpus=n_cpus,
+                                     resume=resume or len(learning_curve) > 0, print_update=print_update,
+                                     report_startup=report_startup and len(learning_curve) == 0,
+                                     max_sims=min(n_val + n_train, max_sims), settings=settings)
+        manifest = load_manifest(manifest_file)
+        n_done = completed_sims(manifest)
+        with ctx.Pool(1) as pool:
+            val_mse = pool.apply(probe_validation_mse, (campaign_file(output_dir, prefix, 'features'),
+                                                        campaign_file(output_dir, prefix, 'labels'),
+                                                        n_val, n_done - n_val, probe_settings))
+        improvement = np.nan
+        if len(learning_curve):
+            previous_mse = learning_curve[-1]['val_mse']
+            improvement = (previous_mse - val_mse) / previous_mse
+        learning_curve.append({'n_training_simulations': n_done - n_val,
+                               'n_simulations': n_done,
+                               'val_mse': val_mse,
+                               'relative_improvement': improvement})
+        pd.DataFrame(learning_curve).to_csv(learning_curve_file, index=False)
+        print("%s training simulations: validation MSE = %s (relative improvement: %s)" % (
+            n_done - n_val, np.round(val_mse, 5), np.round(improvement, 4)))
+        if n_done >= max_sims or improvement < min_improvement:
+            break
+        n_train = n_train * growth
+    print("Simulations stopped at %s of %s (learning curve saved as: %s)" % (n_done, max_sims, learning_curve_file))
+    return manifest_file
+
+
+def merge_settings(manifest_file):
+    # list of simulation settings (one dictionary per simulation) in simulation order
+    manifest = load_manifest(manifest_file)
+    sim_settings = []
+    for shard in manifest['shards']:
+        with open(os.path.join(manifest['output_dir'], shard['settings']), "rb") as f:
+            sim_settings.extend(pk.load(f))
+    return sim_settings
+
+
+def remove_shards(manifest_file):
+    manifest = load_manifest(manifest_file)
+    reset_campaign(manifest['output_dir'], manifest['prefix'])
@@ -0,0 +1,624 @@
+# Functions for training DeepDive models: streaming and shared input data, scheduling of parallel
+# training, model search (successive halving, fused towers), fine-tuning of trained models and
+# training on simulations generated on the fly
+# Used by the 3.deepdive_model_training.py scripts
+import os
+import sys
+import glob
+import time
+import queue
+import traceback
+import subprocess
+import multiprocessing
+import multiprocessing.connection
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow import keras
+from numpy.lib.format import open_memmap
+import dataset_utilities as du
+import prediction_utilities as pu
+import parallel_utilities as pl
+
+
+def split_rows(n_rows, validation_split=0.2):
+    # as in keras' validation_split, the validation set is the last fraction of the simulations
+    n_train = int(n_rows * (1 - validation_split))
+    return np.arange(0, n_train), np.arange(n_train, n_rows)
+
+
+def batch_generator(features, labels, rows, feature_rescaler, label_transform, batch_size,
+                    shuffle=True, block_batches=10, rng=None):
+    # yields rescaled batches read from memory-mapped arrays or compressed datasets
+    # (feature_rescaler and label_transform can be None if the arrays are already rescaled)
+    # rows are read in contiguous blocks of block_batches batches: with shuffle=True the order
+    # of the blocks and the simulations within each block are shuffled at every epoch
+    block_size = batch_size * block_batches
+    blocks = [rows[i:i + block_size] for i in range(0, len(rows), block_size)]
+    if shuffle:
+        rng = rng or np.random.default_rng()
+        blocks = [blocks[i] for i in rng.permutation(len(blocks))]
+    for block in blocks:
+        x = np.asarray(features[block[0]:block[-1] + 1])
+        y = np.asarray(labels[block[0]:block[-1] + 1])
+        if shuffle:
+            indx = rng.permutation(len(block))
+            x, y = x[indx], y[indx]
+        for i in range(0, len(block), batch_size):
+            x_batch, y_batch = x[i:i + batch_size], y[i:i + batch_size]
+            if feature_rescaler is not None:
+                x_batch = pu.rescale_features(feature_rescaler, x_batch)
+            if label_transform is not None:
+                y_batch = label_transform(y_batch)
+            yield np.asarray(x_batch).astype(np.float32), np.asarray(y_batch).astype(np.float32)
+
+
+def make_dataset(features, labels, rows, feature_rescaler, label_transform, batch_size, shuffle=True, seed=None,
+                 n_outputs=None):
+    # with n_outputs the labels of each batch are repeated for each output of a multi-output model
+    rng = np.random.default_rng(seed)
+    x_shape = tuple(features.shape[1:])
+    y_shape = tuple(labels.shape[1:])
+    dataset = tf.data.Dataset.from_generator(
+        lambda: batch_generator(features, labels, rows, feature_rescaler, label_transform, batch_size,
+                                shuffle=shuffle, rng=rng),
+        output_signature=(tf.TensorSpec(shape=(None,) + x_shape, dtype=tf.float32),
+                          tf.TensorSpec(shape=(None,) + y_shape, dtype=tf.float32)))
+    if n_outputs:
+        dataset = dataset.map(lambda x, y: (x, tuple([y] * n_outputs)))
+    return dataset.prefetch(2)
+
+
+def fit_rnn_streaming(features, labels, model, feature_rescaler, label_transform, criterion="val_loss",
+                      patience=10, verbose=1, batch_size=100, max_epochs=1000, validation_split=0.2, seed=None):
+    # same as dd.fit_rnn, but the features are read, rescaled and split into training and validation
+    # sets batch by batch, so the full dataset (and its rescaled copy) is never held in memory
+    train_rows, val_rows = split_rows(features.shape[0], validation_split)
+    train_set = make_dataset(features, labels, train_rows, feature_rescaler, label_transform, batch_size,
+                             shuffle=True, seed=seed)
+    val_set = make_dataset(features, labels, val_rows, feature_rescaler, label_transform, batch_size,
+                           shuffle=False)
+    early_stop = keras.callbacks.EarlyStopping(monitor=criterion, patience=patience, restore_best_weights=True)
+    history = model.fit(train_set,
+                        epochs=max_epochs,
+                        validation_data=val_set,
+                        verbose=verbose,
+                        callbacks=[early_stop])
+    return history
+
+
+def prepare_shared_training_set(feature_file, label_file, fit_rescaler, label_transform, output_dir,
+                                chunk_rows=1000):
+    # load the training set and fit the rescaler once for a whole grid of models: the rescaled
+    # features and labels are saved as float32 .npy files that all training processes memory-map,
+    # so their pages are shared through the OS page cache instead of being copied by each model
+    features = du.load_array(feature_file, lazy=True)
+    labels = du.load_array(label_file, lazy=True)
+    feature_rescaler = fit_rescaler(features)
+    name = os.path.basename(feature_file).split('.npy')[0].split(du.COMPRESSED_EXT)[0]
+    shared = {'feature_rescaler': feature_rescaler,
+              'shared_features': os.path.join(output_dir, name + "_shared_features.npy"),
+              'shared_labels': os.path.join(output_dir, name + "_shared_labels.npy")}
+    os.makedirs(output_dir, exist_ok=True)
+    try:
+        x_r = open_memmap(shared['shared_features'], mode='w+', dtype=np.float32, shape=tuple(features.shape))
+        y_r = open_memmap(shared['shared_labels'], mode='w+', dtype=np.float32, shape=tuple(labels.shape))
+        for i in range(0, len(features), chunk_rows):
+            x_r[i:i + chunk_rows] = pu.rescale_features(feature_rescaler, np.asarray(features[i:i + chunk_rows]))
+            y_r[i:i + chunk_rows] = label_transform(np.asarray(labels[i:i + chunk_rows]))
+        x_r.flush()
+        y_r.flush()
+        del x_r, y_r
+    except BaseException:
+        remove_shared_training_set(shared)
+        raise
+    return shared
+
+
+def load_shared_training_set(shared):
+    # read-only views of the rescaled arrays saved by prepare_shared_training_set
+    return np.load(shared['shared_features'], mmap_mode='r'), np.load(shared['shared_labels'], mmap_mode='r')
+
+
+def remove_shared_training_set(shared):
+    for key in ['shared_features', 'shared_labels']:
+        if os.path.exists(shared[key]):
+            os.remove(shared[key])
+    try:
+        os.rmdir(os.path.dirname(shared['shared_features']))  # only if empty
+    except OSError:
+        pass
+
+
+def estimate_model_cost(lstm_nodes, dense_nodes, n_features, n_time_bins):
+    # multiply-adds per simulation in a forward pass of the model built by dd.build_rnn
+    # (bidirectional LSTM layers followed by dense layers applied to each time bin)
+    cost = 0
+    n_in = n_features
+    for n in lstm_nodes:
+        cost += 2 * 4 * n * (n_in + n + 1)
+        n_in = 2 * n
+    for n in list(dense_nodes) + [1]:
+        cost += n * (n_in + 1)
+        n_in = n
+    return cost * n_time_bins
+
+
+def thread_budgets(costs, n_cpus):
+    # split the cores among the jobs proportionally to their cost (at least one thread each);
+    # with at least as many jobs as cores every job runs single-threaded
+    costs = np.asarray(costs, dtype=float)
+    if len(costs) >= n_cpus:
+        return np.ones(len(costs), dtype=int)
+    share = n_cpus * costs / np.sum(costs)
+    budgets = np.maximum(1, np.floor(share)).astype(int)
+    # the remaining cores go to the jobs with the largest remainders
+    for i in np.argsort(-(share - np.floor(share)), kind='stable'):
+        if np.sum(budgets) >= n_cpus:
+            break
+        budgets[i] += 1
+    # jobs rounded up to one thread are paid for by the most over-budget jobs
+    while np.sum(budgets) > n_cpus:
+        budgets[np.argmax(np.where(budgets > 1, budgets - share, -np.inf))] -= 1
+    return budgets
+
+
+def _run_job(func, job, job_id, n_threads, result_queue):
+    pl.set_thread_budget(n_threads)
+    start, cpu_start = time.time(), time.process_time()
+    error = None
+    try:
+        func(job)
+    except Exception:
+        error = traceback.format_exc()
+        print(error)
+    wall_time, cpu_time = time.time() - start, time.process_time() - cpu_start
+    result_queue.put({'job': job_id,
+                      'wall_time': wall_time,
+                      'cpu_time': cpu_time,
+                      'cpu_utilization': cpu_time / (wall_time * n_threads) if wall_time > 0 else 0,
+                      'error': error})
+
+
+def run_scheduled(func, jobs, costs, n_cpus, names=None, print_update=print):
+    # run func(job) for all jobs in separate processes, each with a thread budget based on its cost
+    # jobs are started costliest first (longest processing time) whenever enough cores are free
+    # returns a table with thread budget, wall time and CPU utilization of each job (and the traceback
+    # of the jobs that failed, in the error column)
+    budgets = thread_budgets(costs, n_cpus)
+    names = names or [str(i) for i in range(len(jobs))]
+    # processes are spawned so that the thread settings apply when TensorFlow is imported
+    ctx = multiprocessing.get_context("spawn")
+    result_queue = ctx.Queue()
+    pending = [int(i) for i in np.argsort(-np.asarray(costs, dtype=float), kind='stable')]
+    running, records = {}, {}
+    free = n_cpus
+    start = time.time()
+    while pending or running:
+        for i in list(pending):
+            if budgets[i] <= free or not running:
+                env = os.environ.copy()
+                os.environ.update(pl.thread_env(int(budgets[i])))
+                p = ctx.Process(target=_run_job, args=(func, jobs[i], i, int(budgets[i]), result_queue))
+                p.start()
+                os.environ.clear()
+                os.environ.update(env)
+                running[i] = p
+                free -= budgets[i]
+                pending.remove(i)
+                print_update("Started %s with %s threads (%s/%s cores in use)" % (names[i], budgets[i],
+                                                                               n_cpus - free, n_cpus))
+        try:
+            rec = result_queue.get(timeout=5)
+        except queue.Empty:
+            # processes killed without reporting (e.g. out of memory)
+            for i, p in list(running.items()):
+                if p.exitcode is not None and p.exitcode != 0:
+                    rec = {'job': i, 'wall_time': np.nan, 'cpu_time': np.nan, 'cpu_utilization': np.nan,
+                           'error': "exit code %s" % p.exitcode}
+                    break
+            else:
+                continue
+        i = rec['job']
+        running.pop(i).join()
+        free += budgets[i]
+        records[i] = rec
+        print_update("Finished %s in %.1f s (CPU utilization %.2f)" % (names[i], rec['wall_time'],
+                                                                       rec['cpu_utilization']))
+    total_time = time.time() - start
+    report = pd.DataFrame({'model': names,
+                           'estimated_cost': np.asarray(costs, dtype=float),
+                           'threads': budgets,
+                           'wall_time': [records[i]['wall_time'] for i in range(len(jobs))],
+                           'cpu_time': [records[i]['cpu_time'] for i in range(len(jobs))],
+                           'cpu_utilization': [records[i]['cpu_utilization'] for i in range(len(jobs))],
+                           'error': [records[i]['error'] for i in range(len(jobs))]})
+    print_update("Trained %s models in %.1f s, overall CPU utilization: %.2f" % (
+        len(jobs), total_time, np.nansum(report['cpu_time']) / (total_time * n_cpus)))
+    return report
+
+
+def merge_histories(history, new_history):
+    # append the epochs of new_history (a keras History) to those of history
+    if history is None:
+        return new_history
+    n_epochs = len(history.epoch)
+    for key, values in new_history.history.items():
+        history.history[key] = list(history.history.get(key, [])) + list(values)
+    history.epoch = list(history.epoch) + [n_epochs + e for e in new_history.epoch]
+    return history
+
+
+def successive_halving(models, fit, max_epochs=1000, min_epochs=10, eta=3, criterion="val_loss",
+                       print_update=print):
+    # successive halving over a set of models (a dict model name: compiled model):
+    # all models are trained for min_epochs, then only the best 1/eta of them (based on the
+    # lowest criterion so far) continue for eta times as many epochs, and so on until one model is
+    # left, which is trained until max_epochs or early stopping
+    # fit(model, epochs) trains a model for up to the given epochs and returns its keras History,
+    # stopping earlier if the model converged (early stopping)
+    # returns a dict model name: History with all the epochs trained by each model and the set of
+    # models trained to convergence (the others were pruned before early stopping)
+    histories = {name: None for name in models}
+    epochs_done = {name: 0 for name in models}
+    converged = set()
+    candidates = list(models)
+    budget = min_epochs
+    while candidates:
+        for name in candidates:
+            n_epochs = min(budget, max_epochs) - epochs_done[name]
+            new_history = fit(models[name], n_epochs)
+            histories[name] = merge_histories(histories[name], new_history)
+            epochs_done[name] += len(new_history.epoch)
+            if len(new_history.epoch) < n_epochs or epochs_done[name] >= max_epochs:
+                converged.add(name)
+        scores = {name: np.min(histories[name].history[criterion]) for name in candidates}
+        ranked = sorted(candidates, key=lambda name: scores[name])
+        n_keep = int(np.ceil(len(candidates) / eta))
+        print_update("Round with %s epochs: best %s = %s (%s), %s of %s models continue" % (
+            min(budget, max_epochs), criterion, np.round(scores[ranked[0]], 4), ranked[0],
+            len([name for name in ranked[:n_keep] if name not in converged]), len(candidates)))
+        candidates = [name for name in ranked[:n_keep] if name not in converged]
+        if len(candidates) == 1:
+            # the last model left is trained without interruptions
+            budget = max_epochs
+        else:
+            budget *= eta
+    return histories, converged
+
+
+class TowerEarlyStopping(keras.callbacks.Callback):
+    # early stopping tracked separately for each tower of a fused model: the best weights of each
+    # tower are restored at the end and training stops once all towers have stopped improving
+    # (towers that stopped earlier keep being updated, which doesn't affect the others since they
+    # share no weights, but their best weights are restored)
+    def __init__(self, towers, monitors, patience):
+        super().__init__()
+        self.towers = towers
+        self.monitors = monitors
+        self.patience = patience
+        self.best = [np.inf] * len(towers)
+        self.best_weights = [None] * len(towers)
+        self.wait = [0] * len(towers)
+        self.stopped_epoch = [None] * len(towers)
+
+    def on_epoch_end(self, epoch, logs=None):
+        for i, tower in enumerate(self.towers):
+            if self.stopped_epoch[i] is not None:
+                continue
+            value = logs[self.monitors[i]]
+            if value < self.best[i]:
+                self.best[i] = value
+                self.best_weights[i] = tower.get_weights()
+                self.wait[i] = 0
+            else:
+                self.wait[i] += 1
+                if self.wait[i] >= self.patience:
+                    self.stopped_epoch[i] = epoch
+        if np.all([e is not None for e in self.stopped_epoch]):
+            self.model.stop_training = True
+
+    def on_train_end(self, logs=None):
+        for i, tower in enumerate(self.towers):
+            if self.best_weights[i] is not None:
+                tower.set_weights(self.best_weights[i])
+
+
+def fit_fused_rnn(features, labels, towers, feature_rescaler, label_transform, criterion="val_loss",
+                  patience=10, verbose=1, batch_size=100, max_epochs=1000, validation_split=0.2, seed=None):
+    # train several models (a dict model name: compiled model, e.g. from dd.build_rnn) with the same
+    # input shape as towers of a single model, so that each batch is prepared once for all of them
+    # each tower keeps its own loss and early stopping, returns a dict model name: History
+    names = list(towers)
+    inputs = keras.Input(shape=tuple(features.shape[1:]))
+    outputs = [keras.layers.Activation('linear', name="output_%s" % i)(towers[name](inputs))
+               for i, name in enumerate(names)]
+    fused_model = keras.Model(inputs=inputs, outputs=outputs)
+    optimizer = towers[names[0]].optimizer
+    fused_model.compile(loss=[towers[name].loss for name in names],
+                        optimizer=optimizer.__class__.from_config(optimizer.get_config()))
+
+    train_rows, val_rows = split_rows(features.shape[0], validation_split)
+    train_set = make_dataset(features, labels, train_rows, feature_rescaler, label_transform, batch_size,
+                             shuffle=True, seed=seed, n_outputs=len(names))
+    val_set = make_dataset(features, labels, val_rows, feature_rescaler, label_transform, batch_size,
+                           shuffle=False, n_outputs=len(names))
+    early_stop = TowerEarlyStopping([towers[name] for name in names],
+                                    [criterion.replace("loss", "output_%s_loss" % i) for i in range(len(names))],
+                                    patience)
+    fused_history = fused_model.fit(train_set,
+                                    epochs=max_epochs,
+                                    validation_data=val_set,
+                                    verbose=verbose,
+                                    callbacks=[early_stop])
+
+    # split the history by tower, up to the epoch at which each of them stopped
+    histories = {}
+    for i, name in enumerate(names):
+        n_epochs = len(fused_history.epoch)
+        if early_stop.stopped_epoch[i] is not None:
+            n_epochs = early_stop.stopped_epoch[i] + 1
+        history = keras.callbacks.History()
+        history.history = {}
+        for key, values in fused_history.history.items():
+            prefix = "val_" if key.startswith("val_") else ""
+            tower_key = "%soutput_%s_" % (prefix, i)
+            if key.startswith(tower_key):
+                history.history[prefix + key[len(tower_key):]] = list(values[:n_epochs])
+        history.epoch = list(range(n_epochs))
+        histories[name] = history
+    return histories
+
+
+def find_trained_model(model_wd, model_name):
+    # file name (as used by dd.load_rnn_model) of a model saved in model_wd by the training script
+    # or None if there is no such model
+    model_files = glob.glob(os.path.join(model_wd, "*rnn_model*" + model_name))
+    if len(model_files) == 0:
+        return None
+    return os.path.basename(model_files[0]).split("rnn_model")[1]
+
+
+def input_shape_matches(model, features):
+    # dimensions left undefined in the model (None) match any size
+    model_shape = tuple(model.input_shape[1:])
+    if len(model_shape) != len(features.shape) - 1:
+        return False
+    return np.all([m is None or m == f for m, f in zip(model_shape, features.shape[1:])])
+
+
+def rescaler_change(init_rescaler, feature_rescaler, features):
+    # largest difference between the features rescaled with the two rescalers, relative to the
+    # largest rescaled value (0 if the rescalers are equivalent on these features)
+    x_init = pu.rescale_features(init_rescaler, features)
+    x_new = pu.rescale_features(feature_rescaler, features)
+    return np.max(np.abs(x_init - x_new)) / np.max(np.abs(x_new))
+
+
+class SimulationStream():
+    # Simulations generated on the fly by background worker processes (running the simulate()
+    # function of a 2.simulate_*.py script) and received through one connection per worker, so that
+    # simulating and training overlap and no training set is written to disk
+    def __init__(self, script_file, n_workers, seed, timeout=1):
+        # workers are started as new Python processes running simulation_stream_worker.py, so they do not
+        # import the training script (nor TensorFlow) again; a worker waits until each simulation it sends
+        # is read, so only a few simulations per worker are held in memory
+        authkey = os.urandom(32)
+        listener = multiprocessing.connection.Listener(authkey=authkey)
+        worker_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "simulation_stream_worker.py")
+        self.timeout = timeout
+        self.n_simulations = 0
+        self.workers, self.connections = [], []
+        try:
+            for i in range(n_workers):
+                worker = subprocess.Popen([sys.executable, worker_file, listener.address, os.path.abspath(script_file),
+                                           str(seed), str(i), str(n_workers)], stdin=subprocess.PIPE)
+                self.workers.append(worker)
+                worker.stdin.write(authkey.hex().encode() + b"\n")
+                worker.stdin.close()
+                self.connections.append(listener.accept())
+        except BaseException:
+            self.close()
+            raise
+        finally:
+            listener.close()
+
+    def take(self, n):
+        # stack the next n simulations (in order of completion)
+        features, labels = [], []
+        for _ in range(n):
+            sim_index, x, y = self.get()
+            features.append(x)
+            labels.append(y)
+        self.n_simulations += n
+        return np.stack(features), np.stack(labels)
+
+    def get(self):
+        # next simulation, raising an error if a worker failed or all workers stopped
+        while True:
+            ready = multiprocessing.connection.wait(self.connections, timeout=self.timeout)
+            if not ready:
+                if np.all([worker.poll() is not None for worker in self.workers]):
+                    raise RuntimeError("All simulation workers stopped (exit codes: %s)" % (
+                        [worker.returncode for worker in self.workers]))
+                continue
+            # the workers are read in turn
+            conn = ready[0]
+            self.connections.remove(conn)
+            try:
+                sim_index, x, y = conn.recv()
+            except EOFError:
+                # the worker stopped (a worker that fails sends its traceback first)
+                if not self.connections:
+                    raise RuntimeError("All simulation workers stopped (exit codes: %s)" % (
+                        [worker.wait() for worker in self.workers]))
+                continue
+            self.connections.append(conn)
+            if sim_index is None:
+                raise RuntimeError("Simulation worker failed:\n%s" % x)
+            return sim_index, x, y
+
+    def batches(self, batch_size, feature_rescaler, label_transform):
+        # endless generator of rescaled batches of new simulations
+        while True:
+            x, y = self.take(batch_size)
+            yield (pu.rescale_features(feature_rescaler, x).astype(np.float32),
+                   np.asarray(label_transform(y)).astype(np.float32))
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        for worker in self.workers:
+            worker.terminate()
+            worker.wait()
+
+
+def fit_rnn_online(stream, model, feature_rescaler, label_transform, validation_data=None, criterion="val_loss",
+                   patience=10, verbose=1, batch_size=100, steps_per_epoch=100, max_epochs=1000):
+    # same as dd.fit_rnn, but each batch is made of new simulations taken from a SimulationStream
+    # validation_data (rescaled features and labels) is a fixed set evaluated at the end of each epoch;
+    # without it early stopping is based on the training loss
+    x, y = stream.take(1)
+    x_shape = tuple(x.shape[1:])
+    y_shape = tuple(y.shape[1:])
+    train_set = tf.data.Dataset.from_generator(
+        lambda: stream.batches(batch_size, feature_rescaler, label_transform),
+        output_signature=(tf.TensorSpec(shape=(None,) + x_shape, dtype=tf.float32),
+                          tf.TensorSpec(shape=(None,) + y_shape, dtype=tf.float32))).prefetch(2)
+    if validation_data is None:
+        criterion = criterion.replace("val_", "")
+    early_stop = keras.callbacks.EarlyStopping(monitor=criterion, patience=patience, restore_best_weights=True)
+    history = model.fit(train_set,
+                        epochs=max_epochs,
+                        steps_per_epoch=steps_per_epoch,
+                        validation_data=validation_data,
+                        verbose=verbose,
+                        callbacks=[early_stop])
+    return history
+
+
+class StreamingFeatureRescaler():
+    # Feature rescaler fitted incrementally (update) over chunks of the features, which can also be
+    # fitted separately on different parts of the dataset and merged. The running statistics (count,
+    # mean, variance, min, max) are kept per feature, per time bin and feature, and over all values,
+    # so that any of the RESCALING_FORMULAS can be applied, with or without replacing zero
+    # denominators by 1 (see match_formula)
+    REDUCTIONS = {'feature': (0, 1), 'bin_feature': (0,), 'global': None}
+    RESCALING_FORMULAS = ['max', 'max+1', 'min-max', 'mean', 'std', 'z-score']
+
+    def __init__(self, features=None, formula=None):
+        self.stats = None
+        self.formula = formula  # (reduction, formula, zero_guard)
+        if features is not None:
+            self.update(features)
+
+    def _batch_stats(self, x):
+        stats = {}
+        for key, axis in self.REDUCTIONS.items():
+            stats[key] = {'n': x.size if axis is None else int(np.prod([x.shape[a] for a in axis])),
+                          'mean': np.mean(x, axis=axis),
+                          'm2': np.sum((x - np.mean(x, axis=axis, keepdims=True)) ** 2, axis=axis),
+                          'min': np.min(x, axis=axis),
+                          'max': np.max(x, axis=axis)}
+        return stats
+
+    def _merge_stats(self, stats):
+        # parallel update of mean and sum of squared deviations (Chan et al.)
+        if self.stats is None:
+            self.stats = stats
+            return
+        for key in self.REDUCTIONS:
+            a, b = self.stats[key], stats[key]
+            n = a['n'] + b['n']
+            delta = b['mean'] - a['mean']
+            self.stats[key] = {'n': n,
+                               'mean': a['mean'] + delta * b['n'] / n,
+                               'm2': a['m2'] + b['m2'] + delta ** 2 * a['n'] * b['n'] / n,
+                               'min': np.minimum(a['min'], b['min']),
+                               'max': np.maximum(a['max'], b['max'])}
+
+    def update(self, features):
+        self._merge_stats(self._batch_stats(np.asarray(features, dtype=np.float64)))
+        return self
+
+    def merge(self, other):
+        if other.stats is not None:
+            self._merge_stats({key: dict(value) for key, value in other.stats.items()})
+        return self
+
+    def rescale_with(self, features, reduction, formula, zero_guard=False):
+        # (features - shift) / scale, with the zero scales replaced by 1 if zero_guard
+        # (as in rescalers setting e.g. max[max == 0] = 1 for features that are always zero)
+        s = self.stats[reduction]
+        std = np.sqrt(s['m2'] / s['n'])
+        shift, scale = {'max': (0, s['max']),
+                        'max+1': (0, s['max'] + 1),
+                        'min-max': (s['min'], s['max'] - s['min']),
+                        'mean': (0, s['mean']),
+                        'std': (0, std),
+                        'z-score': (s['mean'], std)}[formula]
+        if zero_guard:
+            scale = np.where(scale == 0, 1, scale)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (features - shift) / scale
+
+    def feature_rescale(self, features):
+        return self.rescale_with(features, *self.formula)
+
+
+def portable_rescaler(feature_rescaler):
+    # rescalers fitted by fit_streaming_rescaler are saved with the models as plain arrays (the scale,
+    # or a dictionary with scale and shift), so that loading the models does not require this module
+    # (see pu.rescale_features); other rescalers are returned unchanged
+    if not isinstance(feature_rescaler, StreamingFeatureRescaler):
+        return feature_rescaler
+    affine = pu.affine_rescaler(feature_rescaler, feature_rescaler.stats['bin_feature']['mean'].shape)
+    if np.all(affine.shift == 0):
+        return affine.scale
+    return {'scale': affine.scale, 'shift': affine.shift}
+
+
+def match_formula(reference, features, rtol=1e-9):
+    # rescaling formulas of StreamingFeatureRescaler reproducing reference.feature_rescale(features),
+    # where reference is a rescaler fitted on the same features (e.g. dd.FeatureRescaler(features))
+    features = np.asarray(features)
+    target = np.asarray(reference.feature_rescale(features))
+    probe_rescaler = StreamingFeatureRescaler(features)
+    matches = []
+    for reduction in StreamingFeatureRescaler.REDUCTIONS:
+        for formula in StreamingFeatureRescaler.RESCALING_FORMULAS:
+            for zero_guard in [False, True]:
+                rescaled = probe_rescaler.rescale_with(features, reduction, formula, zero_guard)
+                if rescaled.shape == target.shape and np.allclose(rescaled, target, rtol=rtol, atol=0,
+                                                                  equal_nan=True):
+                    matches.append((reduction, formula, zero_guard))
+    return matches
+
+
+def fit_streaming_rescaler(features, rescaler_class, chunk_rows=1000, probe_rows=1000, rtol=1e-9):
+    # fit a rescaler equivalent to rescaler_class(features) (e.g. dd.FeatureRescaler) reading the
+    # features (memory-mapped array or compressed dataset) one chunk at a time
+    # the rescaling formula is identified by fitting rescaler_class on the first and last probe_rows
+    # simulations: if no formula (or more than one giving different results) matches, rescaler_class
+    # is fitted on the features loaded in memory instead
+    n = features.shape[0]
+    probes = [np.asarray(features[:probe_rows]), np.asarray(features[max(0, n - probe_rows):])]
+    matches = None
+    for probe in probes:
+        probe_matches = match_formula(rescaler_class(probe), probe, rtol=rtol)
+        matches = probe_matches if matches is None else [m for m in matches if m in probe_matches]
+    if len(matches) == 0:
+        print("Warning: %s could not be reproduced by a streaming rescaler, the features are loaded in "
+              "memory to fit it" % rescaler_class.__name__)
+        return rescaler_class(np.asarray(features))
+    feature_rescaler = StreamingFeatureRescaler()
+    for i in range(0, n, chunk_rows):
+        feature_rescaler.update(features[i:i + chunk_rows])
+    # formulas matching the probes must also agree with the statistics of the full dataset
+    results = [feature_rescaler.rescale_with(probes[0], *m) for m in matches]
+    if not np.all([np.allclose(r, results[0], rtol=rtol, atol=0, equal_nan=True) for r in results]):
+        print("Warning: %s matches several rescaling formulas (%s), the features are loaded in memory to "
+              "fit it" % (rescaler_class.__name__, matches))
+        return rescaler_class(np.asarray(features))
+    feature_rescaler.formula = matches[0]
+    return feature_rescaler